@@ -0,0 +1,116 @@
+import re
+from typing import Dict, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import QuerySet
+
+from core.models import Item, ItemCategory, Image
+from core.mp_scrapers.configs import WILDBERRIES_CONFIG
+from core.mp_scrapers.wildberries.wildberries_base import get_mp_wb
+from core.mp_scrapers.wildberries.wildberries_images import WildberriesImageScraper
+from core.mp_scrapers.wildberries.wildberries_items import WildberriesItemScraper
+from core.mp_scrapers.wildberries.wildberries_revisions import WildberriesRevisionScraper
+from core.utils.work_queue import get_claim_candidates
+
+QUEUE_INDEXES = ['item_revision_queue_idx', 'itemcategory_items_queue_idx', 'image_download_queue_idx']
+EXECUTION_TIME_PATTERN = re.compile(r'Execution Time: ([\d.]+) ms')
+
+
+class Command(BaseCommand):
+    help = 'Show plans and timings of scheduler claim queries with and without queue indexes. ' \
+           'Everything is done in one transaction which is rolled back. Queue indexes are dropped inside it, so ' \
+           'item, image and category tables are locked for all scrapers until the end. Run it on a dedicated DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic_items', type=int, default=0,
+                            help='Number of synthetic items to add. Images are 1/5 of it, categories are 1/1000')
+        parser.add_argument('--repeat', type=int, default=5, help='The best time of repeats is shown')
+        parser.add_argument('--plans', action='store_true', help='Print full query plans')
+        parser.add_argument('--lock_tables', action='store_true',
+                            help='Confirm that item, image and category tables can be locked while command works')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Query plans are compared only for PostgreSQL')
+        if not options['lock_tables']:
+            raise CommandError('Dropping queue indexes locks item, image and category tables until the command ends, '
+                               'so scrapers working with this DB are blocked. Add --lock_tables to run it anyway')
+
+        with transaction.atomic():
+            if options['synthetic_items'] > 0:
+                self._create_synthetic_data(options['synthetic_items'])
+            queries = self._get_claim_queries()
+            with_indexes = self._explain_all(queries, options['repeat'])
+            with connection.cursor() as cursor:
+                for index_name in QUEUE_INDEXES:
+                    cursor.execute(f'DROP INDEX {connection.ops.quote_name(index_name)}')
+            without_indexes = self._explain_all(queries, options['repeat'])
+            transaction.set_rollback(True)
+
+        for name in queries:
+            for state, results in [('without queue indexes', without_indexes), ('with queue indexes', with_indexes)]:
+                plan, best_time = results[name]
+                self.stdout.write(f'{name} {state}: {best_time:0.3f} ms')
+                if options['plans']:
+                    self.stdout.write(plan + '\n')
+
+    @staticmethod
+    def _get_claim_queries() -> Dict[str, QuerySet]:
+        """The same queries as scrapers use for claiming work"""
+        config = WILDBERRIES_CONFIG
+        return {
+            'revisions': get_claim_candidates(WildberriesRevisionScraper.get_due_items(), 'start_parse_time',
+                                              ['next_parse_time'], config.bulk_item_step,
+                                              config.revisions_lease_timeout).select_for_update(skip_locked=True),
+            'categories': WildberriesItemScraper.get_due_categories().select_for_update(skip_locked=True).order_by(
+                'item_next_parse_time')[:1],
+            'images': get_claim_candidates(WildberriesImageScraper.get_due_images(), 'start_parse_time',
+                                           ['next_parse_time'], config.images_batch_size,
+                                           config.images_lease_timeout).select_for_update(skip_locked=True),
+        }
+
+    @staticmethod
+    def _explain_all(queries: Dict[str, QuerySet], repeat: int) -> Dict[str, Tuple[str, float]]:
+        results = {}
+        for name, queryset in queries.items():
+            plans = [queryset.explain(analyze=True, buffers=True) for _ in range(max(1, repeat))]
+            times = [float(EXECUTION_TIME_PATTERN.search(plan).group(1)) for plan in plans]
+            results[name] = (plans[times.index(min(times))], min(times))
+        return results
+
+    @staticmethod
+    def _create_synthetic_data(items_num: int) -> None:
+        """
+        Parse times are spread over a day around now. Deleted rows and rows left claimed by crashed workers are never
+        rescheduled, so they have the oldest parse times and are in the head of a plain next_parse_time index
+        """
+        quote = connection.ops.quote_name
+        marketplace_id = get_mp_wb().id
+        parse_time = "CASE WHEN {} OR i %% 100 = 1 THEN now() - interval '30 days' " \
+                     "ELSE now() + (random() - 0.5) * interval '1 day' END"
+        statements = [
+            (f"INSERT INTO {quote(Item._meta.db_table)} (name, marketplace_id, marketplace_source_id, is_adult, "
+             f"is_deleted, created_at, modified_at, next_parse_time, start_parse_time) "
+             f"SELECT 'synthetic', -i, %s, false, i %% 5 = 0, now(), now(), {parse_time.format('i %% 5 = 0')}, "
+             f"CASE WHEN i %% 100 = 1 THEN now() - interval '30 days' END "
+             f"FROM generate_series(1, %s) AS i", [marketplace_id, items_num]),
+            (f"INSERT INTO {quote(Image._meta.db_table)} (image_file, content_hash, etag, last_modified, thumbnail, "
+             f"thumbnail_hash, marketplace_link, marketplace_source_id, created_at, modified_at, next_parse_time, "
+             f"start_parse_time) "
+             f"SELECT '', '', '', '', '', '', 'synthetic/' || i, %s, now(), now(), {parse_time.format('false')}, "
+             f"CASE WHEN i %% 100 = 1 THEN now() - interval '30 days' END "
+             f"FROM generate_series(1, %s) AS i", [marketplace_id, items_num // 5]),
+            (f"INSERT INTO {quote(ItemCategory._meta.db_table)} (name, marketplace_source_id, is_deleted, "
+             f"marketplace_category_url, marketplace_items_in_category, item_next_parse_time, "
+             f"item_start_parse_time, lft, rght, tree_id, level, created_at, modified_at) "
+             f"SELECT 'synthetic', %s, i %% 5 = 0, '', 0, {parse_time.format('i %% 5 = 0')}, "
+             f"CASE WHEN i %% 100 = 1 THEN now() - interval '30 days' END, 1, 2, "
+             f"(SELECT COALESCE(MAX(tree_id), 0) FROM {quote(ItemCategory._meta.db_table)}) + i, 0, now(), now() "
+             f"FROM generate_series(1, %s) AS i", [marketplace_id, max(1, items_num // 1000)]),
+        ]
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute(sql, params)
+            for model in [Item, Image, ItemCategory]:
+                cursor.execute(f'ANALYZE {quote(model._meta.db_table)}')
@@ -0,0 +1,55 @@
+import os
+import pickle
+from typing import List
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.utils.trees import Node, dump_tree
+
+
+class LegacyNode:
+    """Attributes of pickled nodes are only read, nothing of old Node class is called"""
+    pass
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) == ('core.utils.trees', 'Node'):
+            return LegacyNode
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed in category tree pickles')
+
+
+class Command(BaseCommand):
+    help = 'Convert pickled category trees of old versions to snapshots. Snapshot is written next to pickle'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pickle_files', type=str, nargs='+')
+
+    def handle(self, *args, **options):
+        for pickle_file in options['pickle_files']:
+            with open(pickle_file, 'rb') as file:
+                try:
+                    legacy_roots = LegacyUnpickler(file).load()
+                except pickle.UnpicklingError as e:
+                    raise CommandError(f'Can not load {pickle_file}: {e}')
+            snapshot_file = f'{os.path.splitext(pickle_file)[0]}.jsonl'
+            nodes_num = dump_tree(self._convert(legacy_roots), snapshot_file)
+            self.stdout.write(f'{pickle_file} -> {snapshot_file}: {nodes_num} categories')
+
+    @staticmethod
+    def _convert(legacy_roots: List[LegacyNode]) -> List[Node]:
+        """Old nodes have mp_url instead of marketplace_url and may have no items_number"""
+        roots = []
+        stack = [(legacy_node, None) for legacy_node in reversed(legacy_roots)]
+        while stack:
+            legacy_node, parent = stack.pop()
+            url = getattr(legacy_node, 'marketplace_url', None) or legacy_node.mp_url
+            node = Node(legacy_node.name, url, parent=parent, items_number=getattr(legacy_node, 'items_number', 0))
+            # Pickled names are normalized already
+            node.name = legacy_node.name
+            if parent is None:
+                roots.append(node)
+            else:
+                parent.descendants.append(node)
+            stack.extend((descendant, node) for descendant in reversed(legacy_node.descendants))
+        return roots
@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from core.models import ItemRevision, ItemPosition
+from core.utils.logging_helpers import get_logger
+from core.utils.partitions import is_partitioning_supported, create_partitions, remove_partitions, INTERVALS
+
+logger = get_logger()
+
+
+class Command(BaseCommand):
+    help = 'Create future partitions of revisions and positions and remove old ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=str, default='week', choices=list(INTERVALS.keys()))
+        parser.add_argument('--premake', type=int, default=4, help='Number of future partitions to create')
+        parser.add_argument('--retention_days', type=int, help='Remove partitions with older rows only. '
+                                                                'Nothing is removed if not set')
+        parser.add_argument('--mode', type=str, default='detach', choices=['detach', 'drop'],
+                            help='detach keeps removed partitions as tables for archiving')
+
+    def handle(self, *args, **options):
+        if not is_partitioning_supported():
+            raise CommandError('Partitioning is supported only by PostgreSQL')
+
+        interval = options['interval']
+        start = now()
+        end = start + INTERVALS[interval] * options['premake']
+        for model in [ItemRevision, ItemPosition]:
+            created = create_partitions(model, start, end, interval=interval)
+            logger.info(f'Created partitions for {model._meta.db_table}: {created}')
+
+            if options.get('retention_days') is not None:
+                older_than = start - timedelta(days=options['retention_days'])
+                removed = remove_partitions(model, older_than, mode=options['mode'])
+                logger.info(f'Removed partitions for {model._meta.db_table}: {removed}')
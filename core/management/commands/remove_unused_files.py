@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.mp_scrapers.configs import WILDBERRIES_CONFIG
+from core.mp_scrapers.wildberries.wildberries_images import remove_unused_files
+from core.utils.logging_helpers import get_logger
+
+logger = get_logger()
+
+
+class Command(BaseCommand):
+    help = 'Remove image files and thumbnails which are not used by any image. Should be run on schedule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace_hours', type=float,
+                            default=WILDBERRIES_CONFIG.unused_files_grace_period.total_seconds() / 3600,
+                            help='Files stored or reused more recently are kept')
+
+    def handle(self, *args, **options):
+        grace_period = timedelta(hours=options['grace_hours'])
+        for field_name in ['image_file', 'thumbnail']:
+            removed_num = remove_unused_files(field_name, grace_period)
+            logger.info(f'Removed {removed_num} unused files of Image.{field_name}')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.mp_scrapers.wildberries.wildberries_backlog import get_backlog
+
+
+class Command(BaseCommand):
+    help = 'Show remaining work of scrapers. PostgreSQL planner estimates are shown unless --exact is set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--exact', action='store_true', help='Count rows. It is slow for big tables')
+
+    def handle(self, *args, **options):
+        for name, count in get_backlog(exact=options['exact']).items():
+            self.stdout.write(f'wildberries {name} {count}')
@@ -2,12 +2,14 @@ from typing import Dict, Union, Tuple
 
 from django.core.management.base import BaseCommand, CommandError
 
+from core.models import ItemRevision, ItemPosition
 from core.mp_scrapers.wildberries.wildberries_categories import WildberriesCategoryScraper
 from core.mp_scrapers.wildberries.wildberries_images import WildberriesImageScraper
 from core.mp_scrapers.wildberries.wildberries_items import WildberriesItemScraper
 from core.mp_scrapers.wildberries.wildberries_revisions import WildberriesRevisionScraper
 from core.mp_scrapers.wildberries.wildberries_base import WildberriesProcessPool, WildberriesBaseScraper
 from core.utils.logging_helpers import get_logger
+from core.utils.partitions import ensure_partitions_periodically
 
 logger = get_logger()
 
@@ -19,10 +21,13 @@ class Command(BaseCommand):
         parser.add_argument('mp', type=str)
         parser.add_argument('type', type=str)
         parser.add_argument('--source_file', type=str)
+        parser.add_argument('--prune', action='store_true',
+                            help='Soft delete categories which are not in --source_file. Use only with a full tree')
         parser.add_argument('--cpu_multiplayer', type=float)
 
     def handle(self, *args, **options):
         mp, action_type, source_file, cpu_multiplayer = self._get_arguments(options)
+        ensure_partitions_periodically([ItemRevision, ItemPosition])
         try:
             if mp == 'wildberries':
                 wb_process_pool = None
@@ -41,7 +46,8 @@ class Command(BaseCommand):
                     raise CommandError(f"Unrecognized type {action_type} for marketplace {mp}")
                 if cpu_multiplayer == 0 or cpu_multiplayer is None:
                     wb_process_pool = None
-                self._start_worker(scraper, process_pool=wb_process_pool, source_file=source_file)
+                self._start_worker(scraper, process_pool=wb_process_pool, source_file=source_file,
+                                   prune=options['prune'])
             else:
                 raise CommandError(f"Marketplace {mp} does not exist")
         except Exception as e:
@@ -63,15 +69,20 @@ class Command(BaseCommand):
 
     @staticmethod
     def _start_worker(scraper: Union[WildberriesBaseScraper, WildberriesCategoryScraper],
-                      process_pool: WildberriesProcessPool = None, source_file: str = None):
+                      process_pool: WildberriesProcessPool = None, source_file: str = None, prune: bool = False):
         if process_pool:
             process_pool.start_process_pool()
         else:
-            if source_file:
-                scraper.update_from_file(source_file)
-            else:
-                while True:
-                    result = scraper.update_from_mp()
-                    if result == -1:
-                        logger.info(f'Multiprocessing pool stopping. Got result code -1')
-                        break
+            scraper.open_connections()
+            try:
+                if source_file:
+                    scraper.update_from_file(source_file, prune=prune)
+                else:
+                    while True:
+                        ensure_partitions_periodically([ItemRevision, ItemPosition])
+                        result = scraper.update_from_mp()
+                        if result == -1:
+                            logger.info(f'Multiprocessing pool stopping. Got result code -1')
+                            break
+            finally:
+                scraper.close_connections()
@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """Every duplicate is merged into the earliest item with the same marketplace id"""
+    Item = apps.get_model('core', 'Item')
+    ItemRevision = apps.get_model('core', 'ItemRevision')
+    ItemPosition = apps.get_model('core', 'ItemPosition')
+
+    duplicates = Item.objects.values('marketplace_source', 'marketplace_id').annotate(
+        items_count=Count('id'), first_id=Min('id')).filter(items_count__gt=1)
+    for duplicate in duplicates:
+        duplicate_ids = list(Item.objects.filter(
+            marketplace_source=duplicate['marketplace_source'], marketplace_id=duplicate['marketplace_id']).exclude(
+            id=duplicate['first_id']).values_list('id', flat=True))
+
+        ItemRevision.objects.filter(item_id__in=duplicate_ids).update(item_id=duplicate['first_id'])
+        ItemPosition.objects.filter(item_id__in=duplicate_ids).update(item_id=duplicate['first_id'])
+        for relation_name, related_field in [('categories', 'itemcategory_id'), ('images', 'image_id'),
+                                             ('colours', 'colour_id')]:
+            through = getattr(Item, relation_name).through
+            related_ids = through.objects.filter(item_id__in=duplicate_ids).values_list(related_field, flat=True)
+            through.objects.bulk_create([through(**{'item_id': duplicate['first_id'], related_field: related_id})
+                                         for related_id in set(related_ids)], ignore_conflicts=True)
+        Item.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_auto_20200908_1644'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+    ]
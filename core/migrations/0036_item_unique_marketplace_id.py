@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_merge_duplicate_items'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='item',
+            constraint=models.UniqueConstraint(fields=('marketplace_source', 'marketplace_id'),
+                                               name='unique_item_marketplace_id'),
+        ),
+    ]
@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta, timezone
+
+from django.db import migrations, models
+from django.utils.timezone import now
+
+PARTITION_INTERVAL = timedelta(days=7)
+PREMADE_PARTITIONS = 4
+PARTITIONED_TABLES = [('ItemRevision', [('item_id', 'core_item')]),
+                      ('ItemPosition', [('item_id', 'core_item'), ('category_id', 'core_itemcategory')])]
+
+
+def partition_by_created_at(apps, schema_editor):
+    """
+    Turns append-only tables into tables partitioned by created_at range. Existing table is attached as a partition
+    for all rows created before the next period, so no rows are copied.
+    Primary key of a partitioned table has to include created_at, Django still uses id only.
+    All rows created before migration stay in the legacy partition, so queries on them are not pruned by created_at
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.connection.ops.quote_name
+    for model_name, fk_columns in PARTITIONED_TABLES:
+        table = apps.get_model('core', model_name)._meta.db_table
+        legacy = f'{table}_legacy'
+        legacy_end = get_legacy_end(schema_editor, table)
+
+        schema_editor.execute(f'ALTER TABLE {quote(table)} RENAME TO {quote(legacy)}')
+        schema_editor.execute(f'CREATE TABLE {quote(table)} (LIKE {quote(legacy)} INCLUDING DEFAULTS) '
+                              f'PARTITION BY RANGE (created_at)')
+        # Sequence must not be dropped together with legacy partition
+        schema_editor.execute(f"ALTER SEQUENCE {quote(table + '_id_seq')} OWNED BY {quote(table)}.id")
+        schema_editor.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(table + "_id_created_at_pk")} '
+                              f'PRIMARY KEY (id, created_at)')
+        for column, referenced_table in fk_columns:
+            schema_editor.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(f"{table}_{column}_fk")} '
+                                  f'FOREIGN KEY ({quote(column)}) REFERENCES {quote(referenced_table)} (id) '
+                                  f'DEFERRABLE INITIALLY DEFERRED')
+
+        # Partition can not have its own primary key, (id, created_at) key is built for it while attaching
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+                           [legacy])
+            legacy_pk = cursor.fetchone()[0]
+        schema_editor.execute(f'ALTER TABLE {quote(legacy)} DROP CONSTRAINT {quote(legacy_pk)}')
+        schema_editor.execute(f'ALTER TABLE {quote(table)} ATTACH PARTITION {quote(legacy)} '
+                              f'FOR VALUES FROM (MINVALUE) TO (%s)', [legacy_end])
+        for i in range(PREMADE_PARTITIONS):
+            start = legacy_end + i * PARTITION_INTERVAL
+            schema_editor.execute(f"CREATE TABLE {quote(f'{table}_p{start:%Y%m%d}')} PARTITION OF {quote(table)} "
+                                  f"FOR VALUES FROM (%s) TO (%s)", [start, start + PARTITION_INTERVAL])
+
+
+def merge_partitions(apps, schema_editor):
+    """
+    Copies rows of all attached partitions back into a plain table. Partitions detached by manage_partitions are
+    not attached anymore, so their rows are not copied
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.connection.ops.quote_name
+    for model_name, fk_columns in PARTITIONED_TABLES:
+        table = apps.get_model('core', model_name)._meta.db_table
+        plain = f'{table}_plain'
+        sequence = quote(table + '_id_seq')
+
+        schema_editor.execute(f'CREATE TABLE {quote(plain)} (LIKE {quote(table)} INCLUDING DEFAULTS)')
+        schema_editor.execute(f'INSERT INTO {quote(plain)} SELECT * FROM {quote(table)}')
+        # Sequence is owned by partitioned table and would be dropped with it
+        schema_editor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+        schema_editor.execute(f'DROP TABLE {quote(table)}')
+        schema_editor.execute(f'ALTER TABLE {quote(plain)} RENAME TO {quote(table)}')
+        schema_editor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(table)}.id')
+        schema_editor.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(table + "_pkey")} PRIMARY KEY (id)')
+        for column, referenced_table in fk_columns:
+            schema_editor.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(f"{table}_{column}_fk")} '
+                                  f'FOREIGN KEY ({quote(column)}) REFERENCES {quote(referenced_table)} (id) '
+                                  f'DEFERRABLE INITIALLY DEFERRED')
+            schema_editor.execute(f'CREATE INDEX {quote(f"{table}_{column}_idx")} ON {quote(table)} ({quote(column)})')
+
+
+def get_legacy_end(schema_editor, table: str) -> datetime:
+    """
+    Start of the week after the latest row or now. Legacy table gets rows created since Monday too, so its bound
+    can not be the current week start. Weeks start on Monday, the same as in core.utils.partitions
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'SELECT MAX(created_at) FROM {schema_editor.connection.ops.quote_name(table)}')
+        latest = cursor.fetchone()[0]
+    latest = max(latest, now()) if latest is not None else now()
+    week_start = latest.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return week_start - timedelta(days=week_start.weekday()) + PARTITION_INTERVAL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_item_unique_marketplace_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_by_created_at, merge_partitions),
+        migrations.AddIndex(
+            model_name='itemrevision',
+            index=models.Index(fields=['item', 'created_at'], name='itemrevision_item_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='itemposition',
+            index=models.Index(fields=['category', 'created_at'], name='itemposition_cat_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='itemposition',
+            index=models.Index(fields=['item', 'created_at'], name='itemposition_item_created_idx'),
+        ),
+    ]
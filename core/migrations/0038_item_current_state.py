@@ -0,0 +1,53 @@
+from django.db import migrations, models
+
+
+def fill_current_state(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'UPDATE core_item SET current_price = revision.price, current_sale_price = revision.sale_price, '
+        'current_available_qty = revision.available_qty, current_rating = revision.rating, '
+        'current_comments_num = revision.comments_num, current_revision_time = revision.created_at '
+        'FROM (SELECT DISTINCT ON (item_id) * FROM core_itemrevision ORDER BY item_id, created_at DESC, id DESC) '
+        'AS revision WHERE core_item.id = revision.item_id')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_partition_revisions_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='current_available_qty',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='current_comments_num',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='current_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='current_rating',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='current_revision_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='current_sale_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_current_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_item_current_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['marketplace_source', 'next_parse_time'], name='item_revision_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_item_revision_queue_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(start_parse_time__isnull=True), fields=['marketplace_source', 'next_parse_time'], name='image_download_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='itemcategory',
+            index=models.Index(condition=models.Q(('is_deleted', False), ('item_start_parse_time__isnull', True)), fields=['marketplace_source', 'item_next_parse_time'], name='itemcategory_items_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=256),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+            preserve_default=False,
+        ),
+    ]
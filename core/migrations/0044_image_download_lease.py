@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0043_image_thumbnail'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_download_queue_idx',
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['marketplace_source', 'next_parse_time'], name='image_download_queue_idx'),
+        ),
+    ]
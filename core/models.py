@@ -56,6 +56,24 @@ class Item(StandardFields):
 
     is_deleted = models.BooleanField(default=False, db_index=True)
 
+    # Copy of the latest revision. It is updated together with new revisions
+    current_price = models.IntegerField(null=True, blank=True)
+    current_sale_price = models.IntegerField(null=True, blank=True)
+    current_available_qty = models.IntegerField(null=True, blank=True)
+    current_rating = models.FloatField(null=True, blank=True)
+    current_comments_num = models.IntegerField(null=True, blank=True)
+    current_revision_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['marketplace_source', 'marketplace_id'], name='unique_item_marketplace_id'),
+        ]
+        indexes = [
+            # Queue of items due for revision, see WildberriesRevisionScraper.get_due_items
+            models.Index(fields=['marketplace_source', 'next_parse_time'], name='item_revision_queue_idx',
+                         condition=models.Q(is_deleted=False)),
+        ]
+
     def __str__(self):
         try:
             return f'{self.name} ({self.marketplace_id}) {self.brand.name}'
@@ -63,7 +81,8 @@ class Item(StandardFields):
             return f'{self.name} ({self.marketplace_id})'
 
     def get_latest_revision(self):
-        return self.item_revisions.last()
+        # Ordering by partition key lets PostgreSQL stop at the latest partition with revisions of the item
+        return self.item_revisions.order_by('-created_at', '-id').first()
 
 
 class ItemRevision(StandardFields):
@@ -78,6 +97,12 @@ class ItemRevision(StandardFields):
     sale_price = models.IntegerField()
     available_qty = models.IntegerField()
 
+    class Meta:
+        # Table is partitioned by created_at in PostgreSQL, see core.utils.partitions
+        indexes = [
+            models.Index(fields=['item', 'created_at'], name='itemrevision_item_created_idx'),
+        ]
+
     def __str__(self):
         return f'revision_{self.id} {self.item.name} ({self.item.marketplace_id})'
 
@@ -88,6 +113,13 @@ class ItemPosition(StandardFields):
     position_num = models.IntegerField()
     category = models.ForeignKey('ItemCategory', on_delete=models.PROTECT, related_name='item_positions')
 
+    class Meta:
+        # Table is partitioned by created_at in PostgreSQL, see core.utils.partitions
+        indexes = [
+            models.Index(fields=['category', 'created_at'], name='itemposition_cat_created_idx'),
+            models.Index(fields=['item', 'created_at'], name='itemposition_item_created_idx'),
+        ]
+
     def __str__(self):
         return f'position_{self.id} {self.item.name} ({self.item.marketplace_id})'
 
@@ -112,6 +144,11 @@ class ItemCategory(MPTTModel, StandardFields):
 
     class Meta:
         verbose_name_plural = 'item categories'
+        indexes = [
+            # Queue of categories due for items update, see WildberriesItemScraper.get_due_categories
+            models.Index(fields=['marketplace_source', 'item_next_parse_time'], name='itemcategory_items_queue_idx',
+                         condition=models.Q(is_deleted=False, item_start_parse_time__isnull=True)),
+        ]
 
     def __str__(self):
         return f'{self.name} ({self.id})'
@@ -119,12 +156,26 @@ class ItemCategory(MPTTModel, StandardFields):
 
 class Image(StandardFields):
     image_file = models.ImageField(upload_to='image_model_storage/', blank=True)
+    # SHA-256 of image_file content. Files are stored by it, so images with the same content share one file
+    content_hash = models.CharField(max_length=64, blank=True)
+    # Validators of the last downloaded response. They are sent back to get 304 if image is not modified
+    etag = models.CharField(max_length=256, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    thumbnail = models.ImageField(upload_to='image_thumbnails/', blank=True)
+    # content_hash of image_file the thumbnail is made from
+    thumbnail_hash = models.CharField(max_length=64, blank=True)
     marketplace_link = models.CharField(max_length=256, unique=True, db_index=True)
     marketplace_source = models.ForeignKey('Marketplace', on_delete=models.PROTECT)
 
     next_parse_time = models.DateTimeField(null=True, blank=True, db_index=True)
     start_parse_time = models.DateTimeField(null=True, blank=True, db_index=True)
 
+    class Meta:
+        indexes = [
+            # Queue of images due for download, see WildberriesImageScraper.get_due_images
+            models.Index(fields=['marketplace_source', 'next_parse_time'], name='image_download_queue_idx'),
+        ]
+
     def __str__(self):
         return self.marketplace_link
 
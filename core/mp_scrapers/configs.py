@@ -19,4 +19,44 @@ WILDBERRIES_CONFIG = ScraperConfigs(
     categories_parse_frequency=timedelta(days=14),
     images_parse_frequency=timedelta(days=7),
     items_per_page=100,
+    # Pool of the shared aiohttp session. One session lives as long as the worker process does
+    connections_limit=100,
+    connections_limit_per_host=30,
+    keepalive_timeout=30.0,
+    dns_cache_ttl=600,
+    # How many catalog pages of one category are fetched in advance by every worker
+    item_pages_window=8,
+    # Max number of brands, colours and sellers (each) cached by every worker process
+    dimensions_cache_size=50000,
+    # Skip revisions with the same price, sale price, stock, rating and comments number as the previous one
+    revisions_only_changed=True,
+    # Every claimed batch of bulk_item_step items is requested by chunks concurrently
+    revision_chunk_size=200,
+    revision_concurrency=8,
+    # Batches claimed by every revisions worker process at the same time
+    revision_batches_in_flight=4,
+    # Items claimed by crashed worker are claimed again after this time
+    revisions_lease_timeout=timedelta(hours=1),
+    # Images claimed by every worker at once and downloaded concurrently
+    images_batch_size=200,
+    images_concurrency=16,
+    # Bigger images are not downloaded
+    images_max_size=20 * 1024 * 1024,
+    # Images claimed by crashed worker or by a batch failed with error are claimed again after this time
+    images_lease_timeout=timedelta(minutes=30),
+    # Image files and thumbnails are removed by remove_unused_files command only if they are not used for this time
+    unused_files_grace_period=timedelta(days=1),
+    # Thumbnails are made after download in a pool of thumbnails_workers. Format is JPEG or WEBP
+    make_thumbnails=False,
+    thumbnail_size=(256, 256),
+    thumbnail_format='JPEG',
+    thumbnails_workers=2,
+    # Category pages fetched at the same time while crawling the tree
+    categories_concurrency=10,
+    categories_node_attempts=3,
+    # Crawling progress is saved after every step of categories, so it can continue after crash
+    categories_checkpoint_step=100,
+    categories_checkpoint_path='logs/categories_checkpoint.json',
+    # Every crawled tree is saved here as a snapshot, it can be loaded again with --source_file
+    categories_snapshots_dir='logs/categories_snapshots',
 )
@@ -0,0 +1,21 @@
+from typing import Dict
+
+from core.mp_scrapers.wildberries.wildberries_images import WildberriesImageScraper
+from core.mp_scrapers.wildberries.wildberries_items import WildberriesItemScraper
+from core.mp_scrapers.wildberries.wildberries_revisions import WildberriesRevisionScraper
+from core.utils.estimates import estimate_count
+
+
+def get_backlog(exact: bool = False, ttl: float = 60.0) -> Dict[str, int]:
+    """
+    Remaining work of every scraper: categories waiting for items update, items waiting for revision
+    and images waiting for download. Estimates are used unless exact is set
+    """
+    querysets = {
+        'categories': WildberriesItemScraper.get_due_categories(),
+        'revisions': WildberriesRevisionScraper.get_due_items(),
+        'images': WildberriesImageScraper.get_due_images(),
+    }
+    if exact:
+        return {name: queryset.count() for name, queryset in querysets.items()}
+    return {name: estimate_count(f'wildberries_{name}', queryset, ttl=ttl) for name, queryset in querysets.items()}
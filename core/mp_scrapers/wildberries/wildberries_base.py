@@ -1,23 +1,34 @@
 import multiprocessing
+import multiprocessing.util
 import pickle
 import time
 from abc import ABC, abstractmethod
 from typing import Union, Any
 
-from core.models import Marketplace, MarketplaceScheme
+from core.models import Marketplace, MarketplaceScheme, ItemRevision, ItemPosition
 from core.mp_scrapers.configs import WILDBERRIES_CONFIG
+from core.utils.cache import LRUCache
 from core.utils.connector import Connector
 from core.utils.logging_helpers import get_logger
+from core.utils.partitions import ensure_partitions_periodically
 
 logger = get_logger()
 
 
+marketplaces_cache = LRUCache(maxsize=16)
+
+
 def get_mp_wb() -> Marketplace:
+    mp_wildberries = marketplaces_cache.get('Wildberries')
+    if mp_wildberries is not None:
+        return mp_wildberries
+
     scheme_qs = MarketplaceScheme.objects.get_or_create(name='FBM')[0]
     mp_wildberries, is_created = Marketplace.objects.get_or_create(name='Wildberries')
     if is_created:
         mp_wildberries.working_schemes.add(scheme_qs)
         mp_wildberries.save()
+    marketplaces_cache.put('Wildberries', mp_wildberries)
     return mp_wildberries
 
 
@@ -34,13 +45,33 @@ def save_object_for_logging(obj: Any, name: str, type: str = 'pickle') -> None:
 
 class WildberriesBaseScraper(ABC):
     config = WILDBERRIES_CONFIG
-    connector = Connector(use_proxy=config.use_proxy)
-    marketplace_source = get_mp_wb()
+    connector = Connector(use_proxy=config.use_proxy, limit=config.connections_limit,
+                          limit_per_host=config.connections_limit_per_host,
+                          keepalive_timeout=config.keepalive_timeout, dns_cache_ttl=config.dns_cache_ttl)
+
+    @property
+    def marketplace_source(self) -> Marketplace:
+        # Loaded lazily, so importing scrapers does not touch DB
+        return get_mp_wb()
 
     @abstractmethod
     def update_from_mp(self, start_from: int = None) -> int:
         raise NotImplementedError
 
+    @classmethod
+    def open_connections(cls) -> None:
+        cls.connector.open()
+
+    @classmethod
+    def close_connections(cls) -> None:
+        cls.connector.close()
+
+
+def init_pool_worker(scraper: WildberriesBaseScraper) -> None:
+    """Opens shared session once per worker. It is closed by multiprocessing finalizers on worker exit"""
+    scraper.open_connections()
+    multiprocessing.util.Finalize(None, scraper.close_connections, exitpriority=10)
+
 
 class WildberriesProcessPool:
     def __init__(self, scraper: WildberriesBaseScraper, cpu_multiplayer: Union[int, None] = 1):
@@ -55,9 +86,12 @@ class WildberriesProcessPool:
         self.last_error = None
 
     def start_process_pool(self):
-        with multiprocessing.Pool(processes=self.processes) as pool:
+        with multiprocessing.Pool(processes=self.processes, initializer=init_pool_worker,
+                                  initargs=(self.scraper,)) as pool:
             while True:
                 try:
+                    # Workers write revisions and positions, their partitions must exist all the time pool works
+                    ensure_partitions_periodically([ItemRevision, ItemPosition])
                     if self.busy_processes < self.processes:
                         pool.apply_async(self.scraper.update_from_mp, callback=self._busy_processes_reducer,
                                          error_callback=self._stop_processes)
@@ -68,6 +102,10 @@ class WildberriesProcessPool:
 
                     if self.stop_processes:
                         logger.info(f'Multiprocessing pool stopping. Got result code -1')
+                        if self.last_error is None:
+                            # Let busy workers finish their tasks and close their sessions
+                            pool.close()
+                            pool.join()
                         break
                 except KeyboardInterrupt:
                     logger.info(f'Multiprocessing pool stopping. Got KeyboardInterrupt')
@@ -1,18 +1,22 @@
 import asyncio
-import pickle
+import json
+import os
 import re
-from typing import List
+import time
+from collections import deque, defaultdict
+from typing import List, Iterable, Tuple, Union, Dict, Set
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
+from django.db import transaction
+from django.db.models import Count, Min
 from django.utils.timezone import now
-from mptt.querysets import TreeQuerySet
 
 from core.exceptions import SalesUpdaterError
 from core.models import ItemCategory
 from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper, save_object_for_logging
-from core.types import RequestBody
-from core.utils.trees import Node
+from core.types import RequestBody, CategoryTreeDiff
+from core.utils.trees import Node, rebuild_mptt_tree, dump_tree, load_tree, iter_levels, iter_nodes
 from core.utils.logging_helpers import get_logger
 
 logger = get_logger()
@@ -29,27 +33,36 @@ class WildberriesCategoryScraper(WildberriesBaseScraper):
             'x-requested-with': 'XMLHttpRequest',
         }
         self.base_catalog_pattern = 'https://www.wildberries.ru/catalog/{}'
+        # Pages of these categories are not parsed in all attempts, so their descendants are unknown
+        self.failed_urls = set()
 
     def update_from_mp(self, start_from: int = None) -> int:
         logger.info(f'Started parsing categories from marketplace')
-        bs, is_captcha, _ = asyncio.run(self.connector.get_page(RequestBody(self.config.base_categories_url, 'get',
-                                                                            headers=self.all_categories_headers)))
         try:
-            parsed_nodes = self._parse_bs_response(bs)
+            parsed_nodes = self.connector.run(self._crawl_tree())
         except KeyboardInterrupt:
+            # Crawling continues from checkpoint on the next start
             return -1
 
-        with open(f"{now().astimezone().strftime('%Y%m%d')}_parsed_nodes.p", 'wb') as f:
-            pickle.dump(parsed_nodes, f)
+        os.makedirs(self.config.categories_snapshots_dir, exist_ok=True)
+        dump_tree(parsed_nodes, os.path.join(self.config.categories_snapshots_dir,
+                                             f"{now().astimezone().strftime('%Y%m%d')}_parsed_nodes.jsonl"))
 
+        # Fresh crawl has the whole tree, so categories which are not found in it are gone from marketplace
+        self._save_all_results_in_db(parsed_nodes, prune=True, failed_urls=self.failed_urls)
+        self._remove_checkpoint()
         self._check_db_consistency()
         return 0
 
-    def update_from_file(self, load_file: str) -> int:
+    def update_from_file(self, load_file: str, prune: bool = False) -> int:
+        """
+        :param prune: soft delete categories which are not in the file. Snapshot can be old or partial, so it is off
+            by default and file only adds and updates categories
+        """
         logger.info(f'Started parsing categories from file')
-        parsed_nodes = pickle.load(open(load_file, 'rb'))
+        parsed_nodes = load_tree(load_file)
         try:
-            self._save_all_results_in_db(parsed_nodes)
+            self._save_all_results_in_db(parsed_nodes, prune=prune)
         except KeyboardInterrupt:
             return -1
 
@@ -58,19 +71,7 @@ class WildberriesCategoryScraper(WildberriesBaseScraper):
 
     def _parse_bs_response(self, bs: BeautifulSoup) -> List[Node]:
         root_node_tags = bs.find('ul', class_='topmenus').find_all(self._check_root_matching)
-
-        root_nodes = []
-        for tag in root_node_tags:
-            name, url = tag.text, tag.find('a')['href']
-            new_node = Node(name, url, parent=None)
-
-            category, _ = ItemCategory.objects.get_or_create(
-                name=new_node.name, marketplace_category_url=new_node.marketplace_url,
-                marketplace_source=self.marketplace_source, parent=None)
-            new_node.db_id = category.id
-            root_nodes.append(new_node)
-
-        return self._parse_all_descendants(root_nodes)
+        return [Node(tag.text, tag.find('a')['href'], parent=None) for tag in root_node_tags]
 
     def _check_root_matching(self, tag: Tag) -> bool:
         """
@@ -87,56 +88,134 @@ class WildberriesCategoryScraper(WildberriesBaseScraper):
             re.fullmatch(self.base_catalog_pattern.format('.+'), tag.find('a')['href']) and \
             tag.find('a').text.lower() not in exclude_categories
 
-    def _parse_all_descendants(self, nodes: List[Node], level: int = 0) -> List[Node]:
-        for i, node in enumerate(nodes):
-            # For DEBUGGING
-            if level in [0, 1, 2]:
-                message = f'{i + 1}/{len(nodes)} - {node.name}, level {level}'
-                if level == 0:
-                    logger.debug(message)
-                elif level == 1:
-                    logger.debug('\t'+message)
-                elif level == 2:
-                    logger.debug('\t\t'+message)
-            # Прям до сюда
-
-            descendants_bs, is_captcha, _ = asyncio.run(self.connector.get_page(
-                RequestBody(node.marketplace_url, 'get')))
-
-            # Update number of items in category
-            items_number = self._get_items_number(descendants_bs)
-            current_category = ItemCategory.objects.get(id=node.db_id)
-            current_category.marketplace_items_in_category = items_number
-            current_category.save()
-
-            if level == 0:
-                all_items = self._extract_catalogs_from_root(descendants_bs)
-                for item in all_items:
-                    url = self.config.base_url + item.find('a')['href']
-                    item_name = item.find('a').text.strip('\n') if item.find('a').text.strip('\n') else item.find(
-                        'a')['title']
-                    node.descendants.append(self._get_node(item_name, url, node))
-            else:
+    async def _crawl_tree(self) -> List[Node]:
+        """
+        Breadth-first crawl. Categories are fetched by chunks of categories_checkpoint_step concurrently, after every
+        chunk all found categories and the queue are saved to checkpoint. Nothing is written to DB while crawling
+        """
+        nodes, queue, failed_urls = self._load_checkpoint()
+        self.failed_urls = set(failed_urls)
+        if nodes is None:
+            bs, _, _ = await self.connector.get_page(RequestBody(self.config.base_categories_url, 'get',
+                                                                 headers=self.all_categories_headers))
+            nodes = self._parse_bs_response(bs)
+            queue = list(range(len(nodes)))
+        # The same category can be linked from several parents. Only the first found one is kept
+        known_urls = {node.marketplace_url for node in nodes}
+        queue = deque(queue)
+        semaphore = asyncio.Semaphore(self.config.categories_concurrency)
+
+        while queue:
+            chunk = [nodes[queue.popleft()] for _ in range(min(len(queue), self.config.categories_checkpoint_step))]
+            chunk_descendants = await asyncio.gather(*[self._crawl_node(node, semaphore) for node in chunk])
+            for node, descendants in zip(chunk, chunk_descendants):
+                for descendant in descendants:
+                    if descendant.marketplace_url in known_urls:
+                        continue
+                    known_urls.add(descendant.marketplace_url)
+                    node.descendants.append(descendant)
+                    queue.append(len(nodes))
+                    nodes.append(descendant)
+            self._save_checkpoint(nodes, queue, self.failed_urls)
+            logger.debug(f'Found {len(nodes)} categories, {len(queue)} of them are waiting')
+        return [node for node in nodes if node.parent is None]
+
+    async def _crawl_node(self, node: Node, semaphore: asyncio.Semaphore) -> List[Node]:
+        """:return: descendants of node. Node is considered as a leaf if its page is not parsed in all attempts"""
+        level = self._get_level(node)
+        for attempt in range(1, self.config.categories_node_attempts + 1):
+            async with semaphore:
+                descendants_bs, is_captcha, status_code = await self.connector.get_page(
+                    RequestBody(node.marketplace_url, 'get'))
+            if status_code == 404:
+                logger.warning(f'Category {node.name} is not found on {node.marketplace_url}')
+                return []
+            if status_code == 200 and not is_captcha:
                 try:
-                    all_items = descendants_bs.find('div', class_='catalog-sidebar').find_all('li')
-                except AttributeError:
-                    logger.warning("Can't find catalog sidebar")
+                    node.items_number = self._get_items_number(descendants_bs)
+                    return self._parse_descendants(descendants_bs, node, level)
+                except SalesUpdaterError:
+                    pass
+            logger.warning(f'Attempt {attempt} for category {node.name} on level {level} failed with status '
+                           f'{status_code}, captcha {is_captcha}')
+        logger.error(f'All attempts for category {node.name} on {node.marketplace_url} have been used')
+        self.failed_urls.add(node.marketplace_url)
+        return []
+
+    def _parse_descendants(self, descendants_bs: BeautifulSoup, node: Node, level: int) -> List[Node]:
+        descendants = []
+        if level == 0:
+            all_items = self._extract_catalogs_from_root(descendants_bs)
+            for item in all_items:
+                url = self.config.base_url + item.find('a')['href']
+                item_name = item.find('a').text.strip('\n') if item.find('a').text.strip('\n') else item.find(
+                    'a')['title']
+                descendants.append(Node(item_name, url, parent=node))
+        else:
+            try:
+                all_items = descendants_bs.find('div', class_='catalog-sidebar').find_all('li')
+            except AttributeError:
+                logger.warning("Can't find catalog sidebar")
+                return descendants
+
+            is_descendants_started = False
+            for item in all_items:
+                try:
+                    item_class = item['class']
+                except KeyError:
+                    item_class = []
+                if 'hasnochild' in item_class:
+                    is_descendants_started = True
                     continue
+                if is_descendants_started:
+                    url = self.config.base_url + item.find('a')['href']
+                    descendants.append(Node(item.text, url, parent=node))
+        return descendants
 
-                is_descendants_started = False
-                for item in all_items:
-                    try:
-                        item_class = item['class']
-                    except KeyError:
-                        item_class = []
-                    if 'hasnochild' in item_class:
-                        is_descendants_started = True
-                        continue
-                    if is_descendants_started:
-                        url = self.config.base_url + item.find('a')['href']
-                        node.descendants.append(self._get_node(item.text, url, node))
-            self._parse_all_descendants(node.descendants, level + 1)
-        return nodes
+    @staticmethod
+    def _get_level(node: Node) -> int:
+        level = 0
+        while node.parent is not None:
+            node, level = node.parent, level + 1
+        return level
+
+    def _save_checkpoint(self, nodes: List[Node], queue: Iterable[int], failed_urls: Iterable[str]) -> None:
+        node_to_index = {id(node): i for i, node in enumerate(nodes)}
+        checkpoint = {
+            'nodes': [[node.name, node.marketplace_url, node_to_index[id(node.parent)] if node.parent else None,
+                       node.items_number] for node in nodes],
+            'queue': list(queue),
+            'failed_urls': list(failed_urls),
+        }
+        path = self.config.categories_checkpoint_path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Checkpoint is replaced at once, so crash while writing does not break the previous one
+        with open(f'{path}.part', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(f'{path}.part', path)
+
+    def _load_checkpoint(self) -> Tuple[Union[List[Node], None], Union[List[int], None], List[str]]:
+        try:
+            with open(self.config.categories_checkpoint_path) as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return None, None, []
+
+        nodes = []
+        for name, url, parent_index, items_number in checkpoint['nodes']:
+            parent = nodes[parent_index] if parent_index is not None else None
+            node = Node(name, url, parent=parent, items_number=items_number)
+            # Saved name is normalized already, Node would strip it once more
+            node.name = name
+            if parent is not None:
+                parent.descendants.append(node)
+            nodes.append(node)
+        logger.info(f'Crawling is continued from checkpoint with {len(nodes)} categories')
+        return nodes, checkpoint['queue'], checkpoint.get('failed_urls', [])
+
+    def _remove_checkpoint(self) -> None:
+        if os.path.exists(self.config.categories_checkpoint_path):
+            os.remove(self.config.categories_checkpoint_path)
 
     @staticmethod
     def _get_items_number(bs: BeautifulSoup) -> int:
@@ -166,35 +245,147 @@ class WildberriesCategoryScraper(WildberriesBaseScraper):
         save_object_for_logging(descendants_bs.prettify(), 'descendants_bs_root.html', type='string')
         raise SalesUpdaterError
 
-    def _get_node(self, name: str, url: str, parent: Node) -> Node:
-        new_node = Node(name, url, parent=parent)
-        category_id = self._save_node_in_db(new_node, parent)
-        new_node.db_id = category_id
-        return new_node
+    def _check_db_consistency(self) -> None:
+        """
+        Active categories must have active parents and unique urls. Broken ones are soft deleted, so items scraper
+        does not crawl the same pages twice
+        """
+        categories = ItemCategory.objects.filter(marketplace_source=self.marketplace_source, is_deleted=False)
+        with transaction.atomic():
+            duplicates = categories.exclude(marketplace_category_url='').values('marketplace_category_url').annotate(
+                categories_num=Count('id'), first_id=Min('id')).filter(categories_num__gt=1)
+            duplicates_num = 0
+            for duplicate in duplicates:
+                duplicates_num += categories.filter(
+                    marketplace_category_url=duplicate['marketplace_category_url']).exclude(
+                    id=duplicate['first_id']).update(is_deleted=True)
 
-    def _save_node_in_db(self, node: Node, parent_node: Node) -> int:
-        parent = ItemCategory.objects.get(id=parent_node.db_id)
-        category, _ = ItemCategory.objects.get_or_create(name=node.name, marketplace_category_url=node.marketplace_url,
-                                                         marketplace_source=self.marketplace_source, parent=parent)
-        return category.id
+            orphans_num = 0
+            while True:
+                # One level of the tree on every iteration
+                deleted_num = categories.filter(parent__is_deleted=True).update(is_deleted=True)
+                if deleted_num == 0:
+                    break
+                orphans_num += deleted_num
+        if duplicates_num or orphans_num:
+            logger.warning(f'Soft deleted {duplicates_num} categories with duplicated urls and {orphans_num} '
+                           f'categories with deleted parents')
 
-    def _check_db_consistency(self) -> None:
-        pass
-
-    def _save_all_results_in_db(self, parsed_nodes: List[Node], parent: TreeQuerySet = None) -> None:
-        for i, parsed_node in enumerate(parsed_nodes):
-            if parent is None:
-                logger.info(f'{i + 1}/{len(parsed_nodes)}. Saving {parsed_node.name}')
-
-            category, is_created = ItemCategory.objects.get_or_create(name=parsed_node.name,
-                                                                      marketplace_source=self.marketplace_source,
-                                                                      parent=parent)
-            if category.marketplace_items_in_category != parsed_node.items_number:
-                category.marketplace_items_in_category = parsed_node.items_number
-            try:
-                category.marketplace_category_url = parsed_node.marketplace_url
-            except AttributeError:
-                category.marketplace_category_url = parsed_node.mp_url
-            category.save()
-            parsed_node.db_id = category.id
-            self._save_all_results_in_db(parsed_node.descendants, parent=category)
+    def _save_all_results_in_db(self, parsed_nodes: List[Node], prune: bool = False,
+                                failed_urls: Set[str] = frozenset()) -> None:
+        """
+        Parsed categories are matched with existing ones by marketplace_category_url. Tree is written level by level
+        with bulk queries, MPTT fields are rebuilt once in the end. If prune is set, existing categories which are not
+        found in parsed tree are soft deleted, except descendants of failed_urls
+        """
+        start = time.time()
+        url_to_category = self._get_existing_categories()
+        diff = self._get_tree_diff(parsed_nodes, url_to_category, prune, failed_urls)
+        saved_urls = set()
+        with transaction.atomic():
+            with ItemCategory.objects.disable_mptt_updates():
+                for level in iter_levels(parsed_nodes):
+                    self._save_level(level, url_to_category, saved_urls)
+                ItemCategory.objects.filter(id__in=[url_to_category[url].pk for url in diff.vanished]).update(
+                    is_deleted=True)
+            rebuilt_num = rebuild_mptt_tree(ItemCategory)
+        logger.info(f'{len(saved_urls)} categories are saved: {len(diff.added)} added, {len(diff.moved)} moved, '
+                    f'{len(diff.renamed)} renamed, {len(diff.restored)} restored, {len(diff.vanished)} vanished. '
+                    f'MPTT fields of {rebuilt_num} are changed. Elapsed {time.time() - start:0.2f} sec.')
+        for name in ['moved', 'restored', 'vanished']:
+            if getattr(diff, name):
+                logger.debug(f'Categories {name}: {", ".join(getattr(diff, name)[:100])}')
+
+    def _get_tree_diff(self, parsed_nodes: List[Node], url_to_category: Dict[str, ItemCategory], prune: bool,
+                       failed_urls: Set[str]) -> CategoryTreeDiff:
+        """Nothing is changed in DB. Categories are matched by url, so moved category keeps its id and items"""
+        diff = CategoryTreeDiff()
+        id_to_url = {category.pk: url for url, category in url_to_category.items()}
+        parsed_urls = set()
+        for node in iter_nodes(parsed_nodes):
+            url = node.marketplace_url
+            if url in parsed_urls:
+                continue
+            parsed_urls.add(url)
+            category = url_to_category.get(url)
+            if category is None:
+                diff.added.append(url)
+                continue
+            if category.is_deleted:
+                diff.restored.append(url)
+            # Descendants of duplicated category are saved under the first found one, which has the same url
+            if id_to_url.get(category.parent_id) != (node.parent.marketplace_url if node.parent else None):
+                diff.moved.append(url)
+            if category.name != node.name:
+                diff.renamed.append(url)
+
+        if not prune:
+            return diff
+        protected_ids = self._get_descendant_ids(url_to_category, failed_urls)
+        diff.vanished = [url for url, category in url_to_category.items() if url not in parsed_urls and
+                         not category.is_deleted and category.pk not in protected_ids]
+        return diff
+
+    @staticmethod
+    def _get_descendant_ids(url_to_category: Dict[str, ItemCategory], urls: Set[str]) -> Set[int]:
+        parent_to_children = defaultdict(list)
+        for category in url_to_category.values():
+            parent_to_children[category.parent_id].append(category.pk)
+        stack = [url_to_category[url].pk for url in urls if url in url_to_category]
+        descendant_ids = set()
+        while stack:
+            for child_id in parent_to_children[stack.pop()]:
+                if child_id not in descendant_ids:
+                    descendant_ids.add(child_id)
+                    stack.append(child_id)
+        return descendant_ids
+
+    def _get_existing_categories(self) -> Dict[str, ItemCategory]:
+        url_to_category = {}
+        # The earliest category wins if there are several ones with the same url
+        for category in ItemCategory.objects.filter(marketplace_source=self.marketplace_source).order_by('-id').only(
+                'id', 'name', 'parent', 'is_deleted', 'marketplace_category_url', 'marketplace_items_in_category'):
+            url_to_category[category.marketplace_category_url] = category
+        return url_to_category
+
+    def _save_level(self, level: List[Node], url_to_category: Dict[str, ItemCategory], saved_urls: Set[str]) -> None:
+        """:param level: parsed nodes, db_id of their parents is already set"""
+        to_create, to_update = [], []
+        for node in level:
+            url = node.marketplace_url
+            parent_id = node.parent.db_id if node.parent else None
+            category = url_to_category.get(url)
+            if url in saved_urls:
+                # The same category is linked from several parents. Its descendants go to the first saved one
+                pass
+            elif category is None:
+                # MPTT fields are set by rebuild
+                category = ItemCategory(name=node.name, marketplace_category_url=url, parent_id=parent_id,
+                                        marketplace_source=self.marketplace_source,
+                                        marketplace_items_in_category=node.items_number,
+                                        lft=0, rght=0, tree_id=0, level=0)
+                url_to_category[url] = category
+                to_create.append(category)
+            elif (category.name, category.parent_id, category.marketplace_items_in_category, category.is_deleted) != \
+                    (node.name, parent_id, node.items_number, False):
+                category.name, category.parent_id = node.name, parent_id
+                category.marketplace_items_in_category = node.items_number
+                # Category is restored if it appears again
+                category.is_deleted = False
+                to_update.append(category)
+            saved_urls.add(url)
+
+        ItemCategory.objects.bulk_create(to_create, batch_size=1000)
+        if to_create and to_create[0].pk is None:
+            # Only PostgreSQL returns ids of created rows
+            url_to_id = dict(ItemCategory.objects.filter(
+                marketplace_source=self.marketplace_source,
+                marketplace_category_url__in=[category.marketplace_category_url for category in to_create]
+            ).values_list('marketplace_category_url', 'id'))
+            for category in to_create:
+                category.pk = url_to_id[category.marketplace_category_url]
+        ItemCategory.objects.bulk_update(to_update, ['name', 'parent', 'marketplace_items_in_category', 'is_deleted'],
+                                         batch_size=1000)
+
+        for node in level:
+            node.db_id = url_to_category[node.marketplace_url].pk
@@ -1,52 +1,240 @@
 import asyncio
+import multiprocessing
+import os
 import time
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from typing import List, Tuple, Dict, Union
 
-from django.core.files.base import ContentFile
-from django.db import connection, transaction
+from django.db import connection
+from django.db.models import QuerySet
 from django.utils.timezone import now
 
 from core.models import Image
-from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper
-from core.types import RequestBody
+from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper, get_mp_wb
+from core.types import RequestBody, DownloadedFile, ScraperConfigs
 from core.utils.logging_helpers import get_logger
+from core.utils.thumbnails import make_thumbnail, THUMBNAIL_EXTENSIONS
+from core.utils.work_queue import claim_batch
 
 logger = get_logger()
 
 
 class WildberriesImageScraper(WildberriesBaseScraper):
+    thumbnails_executor = None
+    # Thumbnails of the previous batch: thumbnail name to images and to future of make_thumbnail
+    pending_thumbnails = None
+
     def update_from_mp(self, start_from: int = None) -> int:
         start = time.time()
         connection.close()
-        image = self._get_image_to_download()
+        images = self._get_images_to_download()
+        # Thumbnails of the previous batch were made while it was saved and the next one was claimed
+        self._finish_thumbnails()
 
-        if image is not None:
-            self._download_image_and_update_fields(image)
-            logger.debug(f'Done in {time.time() - start:0.0f} seconds')
-        else:
+        if len(images) == 0:
             return -1
+        downloaded = self.connector.run(self._download_images(images))
+        self._update_images(images, downloaded)
+        if self.config.make_thumbnails:
+            self._submit_thumbnails(images)
+        logger.debug(f'{len(images)} images done in {time.time() - start:0.0f} seconds')
         return 0
 
-    def _get_image_to_download(self) -> Image:
-        with transaction.atomic():
-            image = Image.objects.select_for_update(skip_locked=True).filter(
-                marketplace_source=self.marketplace_source,
-                next_parse_time__lte=now(), start_parse_time__isnull=True).order_by('next_parse_time').first()
-            if image is not None:
-                self._update_start_parse_time(image)
-                return image
+    @classmethod
+    def close_connections(cls) -> None:
+        super().close_connections()
+        try:
+            cls._finish_thumbnails()
+        except Exception as e:
+            # Thumbnails are made again on the next refresh of these images
+            logger.error(f'Can not save thumbnails of the last batch: {e}')
+        if cls.thumbnails_executor is not None:
+            cls.thumbnails_executor.shutdown()
+            cls.thumbnails_executor = None
+
+    @classmethod
+    def get_thumbnails_executor(cls) -> Executor:
+        if cls.thumbnails_executor is None:
+            if multiprocessing.current_process().daemon:
+                # Workers of multiprocessing.Pool are daemonic and can not have child processes. Pillow releases GIL
+                # while decoding and resizing, so threads still help
+                cls.thumbnails_executor = ThreadPoolExecutor(max_workers=cls.config.thumbnails_workers)
+            else:
+                cls.thumbnails_executor = ProcessPoolExecutor(max_workers=cls.config.thumbnails_workers)
+        return cls.thumbnails_executor
+
+    @staticmethod
+    def get_due_images() -> QuerySet:
+        """Images waiting for download, including claimed ones. Matches image_download_queue_idx"""
+        return Image.objects.filter(marketplace_source=get_mp_wb(), next_parse_time__lte=now())
+
+    def _get_images_to_download(self) -> List[Image]:
+        return claim_batch(self.get_due_images(), 'start_parse_time', ['next_parse_time'],
+                           self.config.images_batch_size, self.config.images_lease_timeout)
+
+    async def _download_images(self, images: List[Image]) -> List[Tuple[Union[DownloadedFile, None], Dict[str, str],
+                                                                        int]]:
+        semaphore = asyncio.Semaphore(self.config.images_concurrency)
+        download_dir = Image._meta.get_field('image_file').storage.path(f'{get_images_dir()}/.partial')
+        return await asyncio.gather(*[self._download_image(image, semaphore, download_dir) for image in images])
+
+    async def _download_image(self, image: Image, semaphore: asyncio.Semaphore,
+                              download_dir: str) -> Tuple[Union[DownloadedFile, None], Dict[str, str], int]:
+        headers = None
+        if image.image_file and image.content_hash and image.image_file.storage.exists(image.image_file.name):
+            # Image is not downloaded again if it is not modified and its file is in place
+            headers = self.connector.get_conditional_headers(image.etag, image.last_modified) or None
+        async with semaphore:
+            return await self.connector.get_page(RequestBody(image.marketplace_link, 'get', parsing_type='image',
+                                                             headers=headers, download_dir=download_dir,
+                                                             max_size=self.config.images_max_size))
+
+    def _update_images(self, images: List[Image],
+                       downloaded: List[Tuple[Union[DownloadedFile, None], Dict[str, str], int]]) -> None:
+        not_modified_num = 0
+        try:
+            for image, (downloaded_file, validators, status_code) in zip(images, downloaded):
+                if status_code == 200 and downloaded_file is not None:
+                    self._store_image(image, downloaded_file)
+                    image.etag = validators.get('ETag', '')
+                    image.last_modified = validators.get('Last-Modified', '')
+                elif status_code == 304:
+                    not_modified_num += 1
+                else:
+                    logger.error(f'Can not download image on link {image.marketplace_link}')
+                image.next_parse_time = now() + self.config.images_parse_frequency
+                image.start_parse_time = None
+        finally:
+            # Files which are not moved to storage because of errors
+            for downloaded_file, _, _ in downloaded:
+                if downloaded_file is not None and os.path.exists(downloaded_file.path):
+                    os.remove(downloaded_file.path)
+        Image.objects.bulk_update(images, ['image_file', 'content_hash', 'etag', 'last_modified', 'next_parse_time',
+                                           'start_parse_time'])
+        logger.debug(f'{not_modified_num} of {len(images)} images are not modified')
 
     @staticmethod
-    def _update_start_parse_time(image: Image) -> None:
-        image.start_parse_time = now()
-        image.save()
-
-    def _download_image_and_update_fields(self, image: Image) -> None:
-        img_bytes, _, status_code = asyncio.run(self.connector.get_page(RequestBody(image.marketplace_link, 'get',
-                                                                                    parsing_type='image')))
-        if status_code == 200:
-            image.image_file.save(image.marketplace_link.split('/')[-1], ContentFile(img_bytes), save=False)
-        else:
-            logger.error(f'Can not find image on link {image.marketplace_link}')
-        image.next_parse_time = now() + self.config.images_parse_frequency
-        image.start_parse_time = None
-        image.save()
+    def _store_image(image: Image, downloaded_file: DownloadedFile) -> None:
+        """
+        Downloaded file is moved to storage only if there is no file with the same content yet. Replaced files are not
+        removed here, other processes can be storing images with the same content right now, see remove_unused_files
+        """
+        storage = image.image_file.storage
+        if downloaded_file.content_hash == image.content_hash and image.image_file and \
+                storage.exists(image.image_file.name):
+            return
+
+        name = get_content_file_name(downloaded_file.content_hash, image.marketplace_link)
+        path = storage.path(name)
+        if not touch_file(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if storage.file_permissions_mode is not None:
+                os.chmod(downloaded_file.path, storage.file_permissions_mode)
+            # Temporary file is on the same volume, so file appears in its place whole or does not appear at all
+            os.replace(downloaded_file.path, path)
+        image.image_file.name = name
+        image.content_hash = downloaded_file.content_hash
+
+    def _submit_thumbnails(self, images: List[Image]) -> None:
+        """
+        Thumbnail is made only if image content is changed. Images with the same content share one thumbnail.
+        Jobs are only submitted, the worker goes on with the next batch while they are done
+        """
+        storage = Image._meta.get_field('thumbnail').storage
+        name_to_images = defaultdict(list)
+        for image in images:
+            if image.image_file and image.content_hash != image.thumbnail_hash:
+                name_to_images[get_thumbnail_file_name(image.content_hash, self.config)].append(image)
+
+        executor = self.get_thumbnails_executor()
+        name_to_future = {}
+        for name, same_images in name_to_images.items():
+            if not touch_file(storage.path(name)):
+                name_to_future[name] = executor.submit(make_thumbnail, storage.path(same_images[0].image_file.name),
+                                                       storage.path(name), self.config.thumbnail_size,
+                                                       self.config.thumbnail_format, storage.file_permissions_mode)
+        self.__class__.pending_thumbnails = (name_to_images, name_to_future)
+
+    @classmethod
+    def _finish_thumbnails(cls) -> None:
+        """Waits for thumbnails of the previous batch and saves them"""
+        if cls.pending_thumbnails is None:
+            return
+        name_to_images, name_to_future = cls.pending_thumbnails
+        cls.pending_thumbnails = None
+
+        images = []
+        for name, same_images in name_to_images.items():
+            if name in name_to_future and not name_to_future[name].result():
+                continue
+            for image in same_images:
+                image.thumbnail.name = name
+                image.thumbnail_hash = image.content_hash
+            images.extend(same_images)
+        Image.objects.bulk_update(images, ['thumbnail', 'thumbnail_hash'])
+
+
+def touch_file(path: str) -> bool:
+    """Reused files are touched, so remove_unused_files does not remove them before images point to them"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_unused_files(field_name: str, grace_period: timedelta) -> int:
+    """
+    Removes files of field_name which are not used by any image and are not stored or touched for grace_period.
+    Scrapers store and reuse files in several processes, file without an image can be committed to DB a bit later.
+    Temporary files left by crashed downloads are removed too
+
+    :return: number of removed files
+    """
+    field = Image._meta.get_field(field_name)
+    storage = field.storage
+    deadline = time.time() - grace_period.total_seconds()
+    removed_num = 0
+    for directory, _, file_names in os.walk(storage.path(field.upload_to.strip('/'))):
+        name_to_path = {}
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            if get_modified_time(path) < deadline:
+                name_to_path[os.path.relpath(path, storage.location).replace(os.sep, '/')] = path
+        if not name_to_path:
+            continue
+
+        used_names = set(Image.objects.filter(**{f'{field_name}__in': list(name_to_path)}).values_list(
+            field_name, flat=True))
+        for name in name_to_path.keys() - used_names:
+            # File can be reused while DB is checked
+            if get_modified_time(name_to_path[name]) < deadline:
+                storage.delete(name)
+                removed_num += 1
+    return removed_num
+
+
+def get_modified_time(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return float('inf')
+
+
+def get_images_dir() -> str:
+    return Image._meta.get_field('image_file').upload_to.strip('/')
+
+
+def get_content_file_name(content_hash: str, link: str) -> str:
+    """Nested directories keep number of files in one directory small"""
+    extension = os.path.splitext(link.split('/')[-1])[1]
+    return f'{get_images_dir()}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{extension}'
+
+
+def get_thumbnail_file_name(content_hash: str, config: ScraperConfigs) -> str:
+    directory = Image._meta.get_field('thumbnail').upload_to.strip('/')
+    width, height = config.thumbnail_size
+    extension = THUMBNAIL_EXTENSIONS[config.thumbnail_format]
+    return f'{directory}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}_{width}x{height}{extension}'
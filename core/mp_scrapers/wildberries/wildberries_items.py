@@ -1,29 +1,38 @@
 import asyncio
+import math
 import multiprocessing
 import time
 from collections import defaultdict
-from typing import List, Dict, Tuple, Set, Union, Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Union, Iterable
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
-from django.db import connection, transaction
+from django.db import connection, connections, transaction
 from django.db.utils import DataError
-from django.db.models import Q
-from django.db.models.base import ModelBase
+from django.db.models import Q, QuerySet
 from django.utils.timezone import now
 
 from core.exceptions import SalesUpdaterError
-from core.models import ItemCategory, Item, Brand, Colour, Image, Seller, ItemPosition, ItemRevision
-from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper, save_object_for_logging
+from core.models import ItemCategory, Item, Brand, Colour, Image, Seller, ItemPosition
+from core.mp_scrapers.configs import WILDBERRIES_CONFIG
+from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper, save_object_for_logging, \
+    get_mp_wb
 from core.mp_scrapers.wildberries.wildberries_revisions import WildberriesRevisionScraper
-from core.types import RequestBody
+from core.types import RequestBody, CatalogPage
+from core.utils.bulk_operations import bulk_upsert, bulk_insert_values, RelationsBuffer
+from core.utils.estimates import estimate_count
 from core.utils.logging_helpers import get_logger
+from core.utils.resolvers import ModelResolver
 
 logger = get_logger()
 
 
 class WildberriesItemBase(WildberriesBaseScraper):
     xmlhttp_header: Dict[str, str]
+    brand_resolver = ModelResolver(Brand, 'marketplace_id', cache_size=WILDBERRIES_CONFIG.dimensions_cache_size)
+    colour_resolver = ModelResolver(Colour, 'marketplace_id', cache_size=WILDBERRIES_CONFIG.dimensions_cache_size)
+    seller_resolver = ModelResolver(Seller, 'name', cache_size=WILDBERRIES_CONFIG.dimensions_cache_size)
 
     def __init__(self):
         self.xmlhttp_header = {
@@ -62,104 +71,59 @@ class WildberriesItemBase(WildberriesBaseScraper):
                 save_object_for_logging(json_result, f'returned_json.txt', type='string')
                 return json_result
 
-    def add_items_to_db(self, items: List[Dict]) -> List[Item]:
-        self.lock.acquire()
-        brand_id_to_idx, colour_id_to_idx, seller_id_to_idx, items_info = self._aggregate_info_from_items(items)
+    def add_items_to_db(self, items: List[Dict], relations: RelationsBuffer = None) -> List[Item]:
+        """If relations is passed, colours are only added to it, otherwise they are written immediately"""
+        items_info = self._aggregate_info_from_items(items)
 
-        self._fill_nones_in_items(brand_id_to_idx, items_info, Brand, 'brand', 'marketplace_id')
-        self._fill_nones_in_items(colour_id_to_idx, items_info, Colour, 'colour', 'marketplace_id')
-        self._fill_nones_in_items(seller_id_to_idx, items_info, Seller, 'seller', 'name')
+        self.lock.acquire()
+        self.brand_resolver.fill(self.marketplace_source, items_info, 'brand')
+        self.colour_resolver.fill(self.marketplace_source, items_info, 'colour')
+        self.seller_resolver.fill(self.marketplace_source, items_info, 'seller')
         self.lock.release()
 
         current_time = now()
-        new_items, old_items, colours_old_items, colours_new_items = [], [], [], []
-        fields_to_update = ['name', 'size_name', 'size_orig_name']
-
-        last_marketplace_id = 0
-        self.lock.acquire()
-        for i, item in enumerate(items_info):
-            create_params = {'name': item['name'], 'marketplace_id': item['marketplace_id'],
-                             'marketplace_source': self.marketplace_source, 'root_id': item['root_id'],
-                             'brand': item['brand'], 'size_name': item['size_name'],
-                             'size_orig_name': item['size_orig_name'], 'seller': item['seller'],
-                             'next_parse_time': current_time, 'is_adult': item['is_adult']}
-            get_params = {'marketplace_id': item['marketplace_id'], 'marketplace_source': self.marketplace_source}
-            if i > 0:
-                last_marketplace_id = items_info[i - 1]['marketplace_id']
-            try:
-                existing_item = Item.objects.get(**get_params)
-            except Item.DoesNotExist:
-                new_item = Item(**create_params)
-                self._add_item_and_fill_colours(new_items, colours_new_items, last_marketplace_id, new_item,
-                                                item['colour'].pk)
-                continue
-            except Item.MultipleObjectsReturned:
-                logger.error(f'Something is wrong. You should get one object for params: {get_params}')
-                existing_items = Item.objects.filter(**get_params)
-                existing_item = existing_items.earliest('created_at')
-                for duplicate_item in existing_items.exclude(pk=existing_item.pk):
-                    # Delete existing relations in all duplicates
-                    self._change_revisions_positions_item(duplicate_item, existing_item)
-                    duplicate_item.delete()
-
-            self._update_existing_item(existing_item, item, fields_to_update)
-            self._add_item_and_fill_colours(old_items, colours_old_items,
-                                            last_marketplace_id, existing_item, item['colour'].pk)
-        if old_items:
-            with transaction.atomic():
-                Item.objects.bulk_update(old_items, fields_to_update)
-                for old_item, colour_pks in zip(old_items, colours_old_items):
-                    old_item.colours.add(*colour_pks)
-
-        if new_items:
-            with transaction.atomic():
-                try:
-                    new_items = Item.objects.bulk_create(new_items)
-                except DataError as e:
-                    logger.exception(e)
-                    save_object_for_logging(new_items, 'corrupted_new_items.p')
-                    raise e
-                for new_item, colour_pks in zip(new_items, colours_new_items):
-                    new_item.colours.add(*colour_pks)
-
-        self.lock.release()
+        mp_id_to_item, mp_id_to_colours = {}, defaultdict(list)
+        for item in items_info:
+            # Every colour of item has its own info, but item params are the same
+            if item['marketplace_id'] not in mp_id_to_item:
+                mp_id_to_item[item['marketplace_id']] = Item(
+                    name=item['name'], marketplace_id=item['marketplace_id'],
+                    marketplace_source=self.marketplace_source, root_id=item['root_id'], brand=item['brand'],
+                    size_name=item['size_name'], size_orig_name=item['size_orig_name'], seller=item['seller'],
+                    next_parse_time=current_time, is_adult=item['is_adult'])
+            mp_id_to_colours[item['marketplace_id']].append(item['colour'].pk)
 
-        all_items = old_items + new_items
-        if len(all_items) > 0:
-            all_items.sort(key=lambda x: x.marketplace_id)
+        try:
+            all_items = self._upsert_items(list(mp_id_to_item.values()), ['name', 'size_name', 'size_orig_name'])
+        except DataError as e:
+            logger.exception(e)
+            save_object_for_logging(list(mp_id_to_item.values()), 'corrupted_new_items.p')
+            raise e
+
+        to_flush = relations is None
+        relations = RelationsBuffer() if relations is None else relations
+        for item in all_items:
+            for colour_pk in mp_id_to_colours[item.marketplace_id]:
+                relations.add(Item.colours, item.pk, colour_pk)
+        if to_flush:
+            relations.flush()
         return all_items
 
     def add_empty_items_to_db(self, items: List[Dict]) -> List[Item]:
         current_time = now()
-        new_items, old_items = [], []
-
-        self.lock.acquire()
-        for i, item in enumerate(items):
-            create_params = {'name': item['name'], 'marketplace_id': item['marketplace_id'],
-                             'marketplace_source': self.marketplace_source, 'next_parse_time': current_time}
-
-            get_params = {'marketplace_id': item['marketplace_id'], 'marketplace_source': self.marketplace_source}
-            try:
-                old_items.append(Item.objects.get(**{'marketplace_id': 12731124, 'marketplace_source': self.marketplace_source}))
-                old_items.append(Item.objects.get(**get_params))
-            except Item.DoesNotExist:
-                new_items.append(Item(**create_params))
-                continue
-            except Item.MultipleObjectsReturned:
-                logger.error(f'Something is wrong. You should get one object for params: {get_params}')
-                existing_items = Item.objects.filter(**get_params)
-                old_items.append(existing_items[0])
-                for duplicate_item in existing_items[1:]:
-                    duplicate_item.delete()
-
-        if new_items:
-            new_items = Item.objects.bulk_create(new_items)
-        self.lock.release()
+        new_items = [Item(name=item['name'], marketplace_id=item['marketplace_id'],
+                          marketplace_source=self.marketplace_source, next_parse_time=current_time) for item in items]
+        # Existing items are left untouched
+        return self._upsert_items(new_items, [])
 
-        all_items = old_items + new_items
-        if len(all_items) > 0:
-            all_items.sort(key=lambda x: x.marketplace_id)
-        return all_items
+    @staticmethod
+    def _upsert_items(items: List[Item], update_fields: List[str]) -> List[Item]:
+        """Returned items are sorted by marketplace_id and have only fields needed for revisions loaded"""
+        return bulk_upsert(Item, items, unique_fields=['marketplace_source', 'marketplace_id'],
+                           update_fields=update_fields,
+                           returning=['id', 'marketplace_id', 'next_parse_time', 'current_price', 'current_sale_price',
+                                      'current_available_qty', 'current_rating', 'current_comments_num',
+                                      'current_revision_time'])
 
     @staticmethod
     def _is_valid_result(json_result: Dict) -> bool:
@@ -175,106 +139,36 @@ class WildberriesItemBase(WildberriesBaseScraper):
                     return False
             return True
 
-    def _aggregate_info_from_items(self, items: List[Dict]) -> Tuple[
-        Dict[Union[str, int], List[int]], Dict[Union[str, int], List[int]], Dict[Union[str, int], List[int]], List[
-            Dict]]:
-        brand_id_to_idx, colour_id_to_idx = defaultdict(list), defaultdict(list)
-        seller_id_to_idx, items_info = defaultdict(list), []
+    def _aggregate_info_from_items(self, items: List[Dict]) -> List[Dict]:
+        items_info = []
         for item in items:
             if item['colors']:
                 for colour in item['colors']:
-                    self._fill_objects(brand_id_to_idx, colour_id_to_idx,
-                                       seller_id_to_idx, items_info, item, colour)
+                    items_info.append(self._get_item_info(item, colour))
             else:
                 colour = {'name': ''}
-                self._fill_objects(brand_id_to_idx, colour_id_to_idx, seller_id_to_idx, items_info, item, colour)
-        return brand_id_to_idx, colour_id_to_idx, seller_id_to_idx, items_info
+                items_info.append(self._get_item_info(item, colour))
+        return items_info
 
-    def _fill_objects(self, brand_id_to_idx: Dict[Union[str, int], List[int]],
-                      colour_id_to_idx: Dict[Union[str, int], List[int]],
-                      seller_id_to_idx: Dict[Union[str, int], List[int]], items_info: List[Dict], item: Dict,
-                      colour: Dict) -> None:
+    @staticmethod
+    def _get_item_info(item: Dict, colour: Dict) -> Dict:
+        """Brand, seller and colour are kept as model params until they are resolved in bulk"""
         new_item_info = {'name': item['name'][:255], 'marketplace_id': item['id'], 'root_id': item['root'],
                          'brand': None, 'colour': None, 'size_name': '', 'size_orig_name': '', 'seller': None,
                          'is_adult': item['isAdult']}
         if item['sizes']:
             new_item_info['size_name'] = item['sizes'][0]['name']
             new_item_info['size_orig_name'] = item['sizes'][0]['origName']
-        items_info.append(new_item_info)
 
         brand_name = item.get('brand') if item.get('brand') is not None else ''
-        brand_params = {'name': brand_name, 'marketplace_source': self.marketplace_source,
-                        'marketplace_id': item.get('brandId')}
-        self._prepare_model(items_info, brand_id_to_idx, Brand, brand_params, 'brand', 'marketplace_id')
+        new_item_info['brand'] = {'name': brand_name, 'marketplace_id': item.get('brandId')}
 
         seller_name = item.get('sellerName') if item.get('sellerName') is not None else ''
-        seller_params = {'name': seller_name, 'marketplace_source_id': self.marketplace_source.id}
-        self._prepare_model(items_info, seller_id_to_idx, Seller, seller_params, 'seller',
-                            ['name', 'marketplace_source_id'])
+        new_item_info['seller'] = {'name': seller_name}
 
         colour_name = colour.get('name') if colour.get('name') is not None else ''
-        colour_params = {'name': colour_name, 'marketplace_source': self.marketplace_source,
-                         'marketplace_id': colour.get('id')}
-        self._prepare_model(items_info, colour_id_to_idx, Colour, colour_params, 'colour', 'marketplace_id')
-
-    @staticmethod
-    def _prepare_model(to_fill: List[Dict], fill_id_to_idx: Dict[Union[str, int], List[int]],
-                       model: Union[Brand, Colour, Seller, Callable], params: Dict[str, Any], model_name: str,
-                       field_for_ident: Union[str, List[str]]) -> None:
-        try:
-            to_fill[-1][model_name] = model.objects.get(**params)
-        except model.DoesNotExist:
-            to_fill[-1][model_name] = model(**params)
-            if isinstance(field_for_ident, str):
-                fill_id_to_idx[params[field_for_ident]].append(len(to_fill) - 1)
-            else:
-                field_name = ' '.join([str(params[name]) for name in field_for_ident])
-                fill_id_to_idx[field_name].append(len(to_fill) - 1)
-        except model.MultipleObjectsReturned:
-            repeating_items = model.objects.filter(**params)
-            to_fill[-1][model_name] = repeating_items[0]
-            for repeating_item in repeating_items[1:]:
-                repeating_item.delete()
-
-    @staticmethod
-    def _fill_nones_in_items(id_to_idx: Dict[Union[str, int], List[int]],
-                             items_info: List[Dict], model: Union[ModelBase, Brand, Colour, Seller], model_name: str,
-                             field_to_ident: Union[str, List[str]]) -> None:
-        new_models = [items_info[idxs[0]][model_name] for idxs in id_to_idx.values()]
-
-        new_models = model.objects.bulk_create(new_models)
-        for model in new_models:
-            if isinstance(field_to_ident, str):
-                idxs: List[int] = id_to_idx[model.__getattribute__(field_to_ident)]
-            else:
-                key = ' '.join([model.__getattribute__(field) for field in field_to_ident])
-                idxs = id_to_idx[key]
-            for i in idxs:
-                items_info[i][model_name] = model
-
-    @staticmethod
-    def _update_existing_item(item: Item, item_info: Dict, fields_to_update: List[str]) -> None:
-        for field in fields_to_update:
-            item.__setattr__(field, item_info.get(field))
-
-    @staticmethod
-    def _add_item_and_fill_colours(items: List[Item], colours: List[List[int]],
-                                   last_mp_id: int, item: Item, colour_pk: int):
-        if last_mp_id != item.marketplace_id:
-            items.append(item)
-            colours.append([colour_pk])
-        else:
-            colours[-1].append(colour_pk)
-
-    @staticmethod
-    def _change_revisions_positions_item(duplicate_item: Item, existing_item: Item):
-        revisions, positions = duplicate_item.item_revisions.all(), duplicate_item.item_positions.all()
-        for revision in revisions:
-            revision.item = existing_item
-        for position in positions:
-            position.item = existing_item
-        ItemRevision.objects.bulk_update(revisions, ['item'])
-        ItemPosition.objects.bulk_update(positions, ['item'])
+        new_item_info['colour'] = {'name': colour_name, 'marketplace_id': colour.get('id')}
+        return new_item_info
 
 
 class WildberriesItemScraper(WildberriesItemBase):
@@ -303,48 +197,127 @@ class WildberriesItemScraper(WildberriesItemBase):
         logger.info(f'Start update from mp for {category}')
         self._process_all_pages(category)
         logger.info(f'{category} elapsed {(time.time() - start):0.0f} seconds')
+        logger.debug(f'Dimensions cache: brands {self.brand_resolver.cache.stats()}, '
+                     f'colours {self.colour_resolver.cache.stats()}, sellers {self.seller_resolver.cache.stats()}')
         return 0
 
+    @staticmethod
+    def get_due_categories() -> QuerySet:
+        """Leaf categories waiting for items update. Matches itemcategory_items_queue_idx"""
+        return ItemCategory.objects.exclude(children__isnull=False).filter(
+            marketplace_source=get_mp_wb(), is_deleted=False, item_start_parse_time__isnull=True,
+            item_next_parse_time__lte=now())
+
     def _get_category(self) -> ItemCategory:
+        # Estimate is cached, so it does not slow down claims
+        logger.info(f'Remained about {estimate_count("wildberries_categories", self.get_due_categories())} categories')
         with transaction.atomic():
-            start = time.time()
-            num_items = ItemCategory.objects.filter(
-                marketplace_source=self.marketplace_source, is_deleted=False,
-                item_start_parse_time__isnull=True, item_next_parse_time__lte=now()).count()
-            logger.info(f'Remained {num_items} operation elapsed {time.time() - start:0.2f}')
-
-            category = ItemCategory.objects.select_for_update(skip_locked=True).exclude(children__isnull=False).filter(
-                marketplace_source=self.marketplace_source, is_deleted=False,
-                item_start_parse_time__isnull=True, item_next_parse_time__lte=now()).first()
+            category = self.get_due_categories().select_for_update(skip_locked=True).order_by(
+                'item_next_parse_time').first()
             if category is not None:
                 category.item_start_parse_time = now()
                 category.save()
                 return category
 
     def _process_all_pages(self, category: ItemCategory, counter: int = 1, debug: bool = False):
+        window = 1 if debug else self.config.item_pages_window
+        # Django ORM can not be used inside running event loop, so all DB writes go to this thread
+        db_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            self.connector.run(self._process_pages_pipeline(category, counter, window, db_executor, debug))
+        finally:
+            db_executor.submit(connections.close_all).result()
+            db_executor.shutdown()
+
+    async def _process_pages_pipeline(self, category: ItemCategory, counter: int, window: int,
+                                      db_executor: ThreadPoolExecutor, debug: bool = False):
+        """
+        Producer fetches and parses up to window pages ahead, consumer writes them in page order.
+        The first 404 or divGoodsNotFound page finishes category and cancels all pages fetched in advance
+        """
+        loop = asyncio.get_event_loop()
+        pages, slots = asyncio.Queue(), asyncio.Semaphore(window)
+        producer = asyncio.ensure_future(self._produce_pages(category, counter, pages, slots, debug))
+        try:
+            while True:
+                page_task = await pages.get()
+                start = time.time()
+                try:
+                    page = await page_task
+                finally:
+                    slots.release()
+
+                if page.is_last:
+                    # Not found page after the last one does not mean category is empty
+                    is_no_items = page.is_empty and page.number == counter
+                    await loop.run_in_executor(db_executor, self._finish_category, category, is_no_items)
+                    break
+                await loop.run_in_executor(db_executor, self._save_page, category, page)
+                logger.info(f'\tPage number {page.number} for {category} done in {time.time() - start:0.2f} sec.')
+                if debug:
+                    break
+        finally:
+            producer.cancel()
+            pending = [producer]
+            while not pages.empty():
+                page_task = pages.get_nowait()
+                page_task.cancel()
+                pending.append(page_task)
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _produce_pages(self, category: ItemCategory, counter: int, pages: asyncio.Queue,
+                             slots: asyncio.Semaphore, debug: bool = False):
+        previous_task = None
         while True:
-            start = time.time()
-            page_num = f'?page={counter}'
-            bs, _, status_code = asyncio.run(self.connector.get_page(RequestBody(
-                category.marketplace_category_url + page_num, 'get')))
-            if status_code not in [200, 404]:
-                logger.warning(f'Bad response for {category} from marketplace. Try one more time')
-                continue
-            is_no_items = self._is_items_not_found(bs, category, status_code)
-            if status_code == 404 or is_no_items:
-                category.item_next_parse_time = now() + self.config.items_parse_frequency
-                category.item_start_parse_time = None
-                if is_no_items:
-                    category.marketplace_items_in_category = 0
-                category.save()
-                break
-            else:
-                self._update_num_items_in_category(bs, category)
-                self._process_items_on_page(bs, category, counter - 1)
-            logger.info(f'\tPage number {counter} for {category} done in {time.time() - start:0.2f} sec.')
-            counter += 1
+            await slots.acquire()
+            if previous_task is not None and counter > self._get_expected_pages(category):
+                # Number of items may be outdated. Beyond expected last page we check pages one by one
+                await asyncio.wait([previous_task])
+                if previous_task.exception() is not None or previous_task.result().is_last:
+                    slots.release()
+                    return
+            previous_task = asyncio.ensure_future(self._fetch_page(category, counter))
+            pages.put_nowait(previous_task)
             if debug:
+                return
+            counter += 1
+
+    def _get_expected_pages(self, category: ItemCategory) -> int:
+        return max(1, math.ceil(category.marketplace_items_in_category / self.config.items_per_page))
+
+    async def _fetch_page(self, category: ItemCategory, page_num: int) -> CatalogPage:
+        while True:
+            bs, _, status_code = await self.connector.get_page(RequestBody(
+                category.marketplace_category_url + f'?page={page_num}', 'get'))
+            if status_code in [200, 404]:
                 break
+            logger.warning(f'Bad response for {category} from marketplace. Try one more time')
+
+        loop = asyncio.get_event_loop()
+        page = await loop.run_in_executor(None, self._parse_page, bs, category, page_num, status_code)
+        if not page.is_last:
+            if page.items_in_category is not None:
+                # Producer uses it to know how many pages to fetch in advance
+                category.marketplace_items_in_category = page.items_in_category
+            page.items_info = await self._get_full_api_info(page.item_ids)
+        return page
+
+    def _parse_page(self, bs: BeautifulSoup, category: ItemCategory, page_num: int, status_code: int) -> CatalogPage:
+        is_no_items = self._is_items_not_found(bs, category, status_code)
+        if status_code == 404 or is_no_items:
+            return CatalogPage(page_num, is_last=True, is_empty=is_no_items)
+
+        all_items = bs.find('div', class_='catalog_main_table').findAll('div', class_='dtList')
+        item_ids, img_id_to_objs, img_link_to_ids = self._extract_info_from_page(all_items)
+        return CatalogPage(page_num, items_in_category=self._get_num_items_in_category(bs), item_ids=item_ids,
+                           img_id_to_objs=img_id_to_objs, img_link_to_ids=img_link_to_ids)
+
+    def _finish_category(self, category: ItemCategory, is_no_items: bool):
+        category.item_next_parse_time = now() + self.config.items_parse_frequency
+        category.item_start_parse_time = None
+        if is_no_items:
+            category.marketplace_items_in_category = 0
+        category.save()
 
     @staticmethod
     def _is_items_not_found(bs: BeautifulSoup, category: ItemCategory, status_code: int) -> bool:
@@ -366,38 +339,36 @@ class WildberriesItemScraper(WildberriesItemBase):
             return False
 
     @staticmethod
-    def _update_num_items_in_category(bs: BeautifulSoup, category: ItemCategory):
+    def _get_num_items_in_category(bs: BeautifulSoup) -> Union[int, None]:
         num_tag = bs.findAll('span', class_='goods-count')
         if len(num_tag) == 1:
             # Just parsing number in tag
-            num_tag = int(num_tag[0].text.strip('\n').strip(' ').split(' ')[0])
-            category.marketplace_items_in_category = num_tag
-            category.save()
+            return int(num_tag[0].text.strip('\n').strip(' ').split(' ')[0])
         else:
             logger.error(f'Something is wrong while getting goods count {num_tag}')
 
-    def _process_items_on_page(self, bs: BeautifulSoup, category: ItemCategory, page_num: int):
-        all_items = bs.find('div', class_='catalog_main_table').findAll('div', class_='dtList')
-        item_ids, img_id_to_objs, img_link_to_ids = self._extract_info_from_page(all_items)
-
-        self._create_or_update_imgs(img_link_to_ids, img_id_to_objs)
+    def _save_page(self, category: ItemCategory, page: CatalogPage):
+        if page.items_in_category is not None:
+            category.marketplace_items_in_category = page.items_in_category
+            category.save()
 
-        full_items_info = asyncio.run(self._get_full_api_info(item_ids))
+        self._create_or_update_imgs(page.img_link_to_ids, page.img_id_to_objs)
 
-        empty_ids = list(set(item_ids) - set([item['id'] for item in full_items_info]))
+        relations, empty_items = RelationsBuffer(), []
+        empty_ids = list(set(page.item_ids) - set([item['id'] for item in page.items_info]))
         if empty_ids:
             empty_items_info = self._get_empty_items(empty_ids, category)
             empty_items = self.add_empty_items_to_db(empty_items_info)
-            self._add_category_and_imgs(empty_items, category, img_id_to_objs)
-        else:
-            # We should block execution to avoid concurrency in functions: self.add_empty_items_to_db and
-            # self.add_items_to_db
-            self.add_empty_items_to_db([])
-        full_items = self.add_items_to_db(full_items_info)
-        self._add_category_and_imgs(full_items, category, img_id_to_objs)
+            self._add_category_and_imgs(empty_items, category, page.img_id_to_objs, relations)
+        full_items = self.add_items_to_db(page.items_info, relations)
+        self._add_category_and_imgs(full_items, category, page.img_id_to_objs, relations)
+        relations.flush()
+
+        self.revision_scraper.update_from_args(full_items, page.items_info)
 
-        self.revision_scraper.update_from_args(full_items, full_items_info)
-        self._create_positions(item_ids, category, page_num)
+        mp_id_to_item_id = {item.marketplace_id: item.pk for item in empty_items}
+        mp_id_to_item_id.update((item.marketplace_id, item.pk) for item in full_items)
+        self.create_positions(self._get_positions(page.item_ids, mp_id_to_item_id, category, page.number - 1))
 
     def _extract_info_from_page(self, all_items: List[Tag]) -> Tuple[List[int], Dict[int, Image], Dict[str, int]]:
         marketplace_ids, imgs, link_to_ids = [], {}, {}
@@ -420,18 +391,11 @@ class WildberriesItemScraper(WildberriesItemBase):
         return marketplace_ids, imgs, link_to_ids
 
     def _create_or_update_imgs(self, img_link_to_ids: Dict[str, int], img_id_to_objs: Dict[int, Image]):
-        self.lock.acquire()
-        imgs_filtered = Image.objects.filter(marketplace_link__in=img_link_to_ids.keys())
-        for img_filtered in imgs_filtered:
-            item_id = img_link_to_ids[img_filtered.marketplace_link]
-            img_id_to_objs[item_id] = img_filtered
-
-        new_imgs = Image.objects.bulk_create([img for img in img_id_to_objs.values() if img.pk is None])
-        self.lock.release()
-
-        for new_img in new_imgs:
-            item_id = img_link_to_ids[new_img.marketplace_link]
-            img_id_to_objs[item_id] = new_img
+        imgs = bulk_upsert(Image, list(img_id_to_objs.values()), unique_fields=['marketplace_link'],
+                           update_fields=[], returning=['id', 'marketplace_link'])
+        for img in imgs:
+            item_id = img_link_to_ids[img.marketplace_link]
+            img_id_to_objs[item_id] = img
 
     async def _get_full_api_info(self, item_ids: List[int]) -> List[Dict]:
         items_coroutine = self.get_api_info(item_ids, type_info='items')
@@ -470,27 +434,28 @@ class WildberriesItemScraper(WildberriesItemBase):
                  'marketplace_source': self.marketplace_source} for mp_id in empty_ids]
 
     @staticmethod
-    def _add_category_and_imgs(items: List[Item], category_leaf: ItemCategory,
-                               item_imgs: Dict[int, Image]) -> Set[int]:
-        updated_ids = set()
+    def _add_category_and_imgs(items: List[Item], category_leaf: ItemCategory, item_imgs: Dict[int, Image],
+                               relations: RelationsBuffer) -> None:
         for item in items:
-            item.categories.add(category_leaf)
+            relations.add(Item.categories, item.pk, category_leaf.pk)
 
             image = item_imgs.get(item.marketplace_id)
             if image is not None:
-                item.images.add(image)
-            updated_ids.add(item.marketplace_id)
-        return updated_ids
+                relations.add(Item.images, item.pk, image.pk)
 
-    def _create_positions(self, mp_ids: List[int], category: ItemCategory, page_num: int):
-        items = Item.objects.filter(marketplace_id__in=mp_ids)
-        new_positions = []
+    def _get_positions(self, mp_ids: List[int], mp_id_to_item_id: Dict[int, int], category: ItemCategory,
+                       page_num: int) -> List[Tuple[int, int, int]]:
+        first_position = page_num * self.config.items_per_page + 1
+        positions = []
         for i, mp_id in enumerate(mp_ids):
-            position = page_num * self.config.items_per_page + (i + 1)
-            try:
-                item = next(filter(lambda x: x.marketplace_id == mp_id, items))
-            except StopIteration:
+            item_id = mp_id_to_item_id.get(mp_id)
+            if item_id is None:
                 logger.error(f'Can not find item {mp_id} in DB. Check the problem')
                 continue
-            new_positions.append(ItemPosition(item=item, category=category, position_num=position))
-        ItemPosition.objects.bulk_create(new_positions)
+            positions.append((item_id, category.pk, first_position + i))
+        return positions
+
+    @staticmethod
+    def create_positions(positions: Iterable[Tuple[int, int, int]]) -> int:
+        """Positions are (item_id, category_id, position_num) tuples of any categories and pages"""
+        return bulk_insert_values(ItemPosition, ['item', 'category', 'position_num'], positions)
@@ -1,31 +1,40 @@
 import asyncio
 import time
-from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Union
 
-from django.db import connection, transaction
+from django.db import connection, connections, transaction
+from django.db.models import QuerySet
 from django.utils.timezone import now
 
 from core.models import Item, ItemRevision
-from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper
+from core.mp_scrapers.wildberries.wildberries_base import WildberriesBaseScraper, get_mp_wb
 from core.types import RequestBody
+from core.utils.estimates import estimate_count
 from core.utils.logging_helpers import get_logger
+from core.utils.work_queue import claim_batch
 
 logger = get_logger()
 
 
 class WildberriesRevisionScraper(WildberriesBaseScraper):
     def update_from_mp(self, start_from: int = None) -> int:
+        """Works until there are no items to update, keeping revision_batches_in_flight batches in flight"""
         start = time.time()
         connection.close()
+        logger.debug(f'Remained about {estimate_count("wildberries_revisions", self.get_due_items())} items')
 
-        items, marketplace_ids = self._get_items_to_update()
+        # Django ORM can not be used inside running event loop, so all DB work goes to this thread
+        db_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            updated = self.connector.run(self._run_revision_workers(db_executor))
+        finally:
+            db_executor.submit(connections.close_all).result()
+            db_executor.shutdown()
 
-        if len(marketplace_ids) == 0:
+        if updated == 0:
             return -1
-
-        items_info = self._get_items_info(marketplace_ids)
-        self._execute_revision_update(items, items_info)
-        logger.debug(f'Done in {time.time() - start:0.0f} seconds')
+        logger.debug(f'{updated} items done in {time.time() - start:0.0f} seconds')
         return 0
 
     def update_from_args(self, items: List[Item], items_info: List[Dict]) -> int:
@@ -58,43 +67,96 @@ class WildberriesRevisionScraper(WildberriesBaseScraper):
 
     def _execute_revision_update(self, items: List[Item], items_info: List[Dict]) -> None:
         self.check_items_fullness(items, items_info)
-        new_revisions = self._create_new_revisions(items, items_info)
-        self._update_revision_times(items, new_revisions)
-
-    def _get_items_to_update(self) -> Tuple[List[Item], List[int]]:
         with transaction.atomic():
-            filtered_items_for_update = Item.objects.select_related('marketplace_source').select_for_update(
-                skip_locked=True).filter(
-                is_deleted=False, marketplace_source=self.marketplace_source, next_parse_time__lte=now(),
-                start_parse_time__isnull=True)[:self.config.bulk_item_step]
-
-            for item in filtered_items_for_update:
-                item.revisions_start_parse_time = now()
-            Item.objects.bulk_update(filtered_items_for_update, ['start_parse_time'])
-
-            return filtered_items_for_update, [item.marketplace_id for item in filtered_items_for_update]
-
-    def _get_items_info(self, indices: List[int]) -> List[Dict]:
-        if len(indices) == 0:
-            return []
+            new_revisions = self._create_new_revisions(items, items_info)
+            self._update_revision_times(items, new_revisions)
 
-        str_idxs = ';'.join(map(str, indices))
-        url = self.config.items_api_url.format(str_idxs)
-        json_result, *_ = asyncio.run(self.connector.get_page(RequestBody(url, method='get', parsing_type='json')))
+    def _execute_revision_update_by_ids(self, items: List[Item], id_to_info: Dict[int, Dict]) -> None:
+        items_with_info = [item for item in items if item.marketplace_id in id_to_info]
+        self._execute_revision_update(items_with_info, [id_to_info[item.marketplace_id] for item in items_with_info])
 
-        if json_result['state'] == 0:
-            items_info = json_result['data']['products']
-            start_from = len(items_info)
+        items_without_info = [item for item in items if item.marketplace_id not in id_to_info]
+        if items_without_info:
+            logger.warning(f'Marketplace did not return info for {len(items_without_info)} items')
+            # They are not checked again until the next revisions pass
+            self._update_revision_times(items_without_info, [None] * len(items_without_info))
 
-            # Be careful. This implementation supposes items_info cut ONLY last queries
-            # So, we linearly extend it to match our items
-            items_info.extend(self._get_items_info(indices[start_from:]))
-            return items_info
-        else:
-            logger.error(f'Expected valid state from items_info {json_result}')
+    @staticmethod
+    def get_due_items() -> QuerySet:
+        """Items waiting for revision, including claimed ones. Matches item_revision_queue_idx"""
+        return Item.objects.filter(is_deleted=False, marketplace_source=get_mp_wb(), next_parse_time__lte=now())
 
-    def _create_new_revisions(self, items: List[Item], items_info: List[Dict]) -> List[ItemRevision]:
-        new_revisions = []
+    def _get_items_to_update(self) -> Tuple[List[Item], List[int]]:
+        items = claim_batch(self.get_due_items(), 'start_parse_time', ['next_parse_time'], self.config.bulk_item_step,
+                            self.config.revisions_lease_timeout)
+        return items, [item.marketplace_id for item in items]
+
+    async def _run_revision_workers(self, db_executor: ThreadPoolExecutor) -> int:
+        workers = [asyncio.ensure_future(self._revision_worker(db_executor))
+                   for _ in range(self.config.revision_batches_in_flight)]
+        try:
+            return sum(await asyncio.gather(*workers))
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+
+    async def _revision_worker(self, db_executor: ThreadPoolExecutor) -> int:
+        """Claims, fetches and writes batches one by one. Other workers send requests while this one uses DB"""
+        loop = asyncio.get_event_loop()
+        updated = 0
+        while True:
+            items, marketplace_ids = await loop.run_in_executor(db_executor, self._get_items_to_update)
+            if len(marketplace_ids) == 0:
+                return updated
+
+            start = time.time()
+            id_to_info = await self._fetch_items_info(marketplace_ids)
+            await loop.run_in_executor(db_executor, self._execute_revision_update_by_ids, items, id_to_info)
+            updated += len(items)
+            logger.debug(f'Batch of {len(items)} items done in {time.time() - start:0.2f} sec.')
+
+    async def _fetch_items_info(self, indices: List[int]) -> Dict[int, Dict]:
+        """Chunks of indices are requested concurrently on shared session. Result is matched by item id"""
+        if len(indices) == 0:
+            return {}
+
+        semaphore = asyncio.Semaphore(self.config.revision_concurrency)
+        step = self.config.revision_chunk_size
+        chunks_info = await asyncio.gather(*[self._fetch_chunk_info(indices[i:i + step], semaphore)
+                                             for i in range(0, len(indices), step)])
+        id_to_info = {}
+        for chunk_info in chunks_info:
+            id_to_info.update(chunk_info)
+        return id_to_info
+
+    async def _fetch_chunk_info(self, indices: List[int], semaphore: asyncio.Semaphore) -> Dict[int, Dict]:
+        id_to_info, remained = {}, indices
+        while remained:
+            url = self.config.items_api_url.format(';'.join(map(str, remained)))
+            async with semaphore:
+                json_result, *_ = await self.connector.get_page(RequestBody(url, method='get', parsing_type='json'))
+            if json_result['state'] != 0:
+                logger.error(f'Expected valid state from items_info {json_result}')
+                break
+
+            remained_set = set(remained)
+            received = {info['id']: info for info in json_result['data']['products'] if info['id'] in remained_set}
+            if not received:
+                # The rest of items does not exist on marketplace anymore
+                break
+            # Response could be cut, so we request the rest of chunk once more
+            id_to_info.update(received)
+            remained = [idx for idx in remained if idx not in id_to_info]
+        return id_to_info
+
+    def _create_new_revisions(self, items: List[Item], items_info: List[Dict]) -> List[Union[ItemRevision, None]]:
+        """
+        :return: revision for every item. If revisions_only_changed is set, revisions equal to current state
+        of items are not saved and None is returned for them
+        """
+        new_revisions, revisions_to_save = [], []
         assert len(items_info) == len(items)
         for item_info, item in zip(items_info, items):
             available_qty = self._get_available_qty(item_info)
@@ -104,8 +166,21 @@ class WildberriesRevisionScraper(WildberriesBaseScraper):
             new_revision = ItemRevision(item=item, rating=item_info['rating'], comments_num=item_info['feedbackCount'],
                                         is_new=item_info['icons']['isNew'], price=price,
                                         sale_price=sale_price, available_qty=available_qty)
-            new_revisions.append(new_revision)
-        return ItemRevision.objects.bulk_create(new_revisions)
+            if self.config.revisions_only_changed and not self._is_changed(item, new_revision):
+                new_revisions.append(None)
+            else:
+                new_revisions.append(new_revision)
+                revisions_to_save.append(new_revision)
+        ItemRevision.objects.bulk_create(revisions_to_save)
+        return new_revisions
+
+    @staticmethod
+    def _is_changed(item: Item, revision: ItemRevision) -> bool:
+        if item.current_revision_time is None:
+            return True
+        return (item.current_price, item.current_sale_price, item.current_available_qty, item.current_rating,
+                item.current_comments_num) != (revision.price, revision.sale_price, revision.available_qty,
+                                               revision.rating, revision.comments_num)
 
     @staticmethod
     def _get_available_qty(item_info: Dict) -> int:
@@ -115,12 +190,25 @@ class WildberriesRevisionScraper(WildberriesBaseScraper):
                 result += stock['qty']
         return result
 
-    def _update_revision_times(self, items: List[Item], new_revisions: List[ItemRevision]) -> None:
+    def _update_revision_times(self, items: List[Item], new_revisions: List[Union[ItemRevision, None]]) -> None:
+        """Besides parse times it updates copy of the latest saved revision in items"""
         items_to_update = []
         assert len(new_revisions) == len(items)
         for revision, item in zip(new_revisions, items):
             item.next_parse_time = now() + self.config.revisions_parse_frequency
             item.start_parse_time = None
+            if revision is not None:
+                self._update_current_state(item, revision)
             items_to_update.append(item)
-        Item.objects.bulk_update(items_to_update, ['next_parse_time',
-                                                   'start_parse_time'])
+        Item.objects.bulk_update(items_to_update, ['next_parse_time', 'start_parse_time', 'current_price',
+                                                   'current_sale_price', 'current_available_qty', 'current_rating',
+                                                   'current_comments_num', 'current_revision_time'])
+
+    @staticmethod
+    def _update_current_state(item: Item, revision: ItemRevision) -> None:
+        item.current_price = revision.price
+        item.current_sale_price = revision.sale_price
+        item.current_available_qty = revision.available_qty
+        item.current_rating = revision.rating
+        item.current_comments_num = revision.comments_num
+        item.current_revision_time = revision.created_at
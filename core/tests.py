@@ -1,3 +1,203 @@
-from django.test import TestCase
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+from django.utils.timezone import now
+
+from core.exceptions import SalesUpdaterError
+from core.models import Brand, Item, ItemCategory, Marketplace, Seller
+from core.utils.bulk_operations import bulk_upsert, bulk_insert_values, bulk_update_values, RelationsBuffer
+from core.utils.cache import LRUCache
+from core.utils.resolvers import ModelResolver
+from core.utils.trees import Node, dump_tree, load_tree, rebuild_mptt_tree, iter_nodes
+from core.utils.work_queue import claim_batch
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 0, 'size': 2, 'maxsize': 2})
+
+    def test_put_refreshes_existing_key(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('a', 10)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 10)
+        self.assertNotIn('b', cache)
+
+
+class BulkOperationsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.marketplace = Marketplace.objects.create(name='Test')
+
+    def _item(self, marketplace_id: int, name: str) -> Item:
+        return Item(name=name, marketplace_id=marketplace_id, marketplace_source=self.marketplace)
+
+    def test_upsert_inserts_and_updates(self):
+        Item.objects.create(name='old', marketplace_id=2, marketplace_source=self.marketplace)
+        result = bulk_upsert(Item, [self._item(3, 'new'), self._item(2, 'changed'), self._item(1, 'first')],
+                             ['marketplace_source', 'marketplace_id'], ['name'], ['id'])
+
+        self.assertEqual([item.marketplace_id for item in result], [1, 2, 3])
+        self.assertTrue(all(item.pk is not None for item in result))
+        # Only returning and unique fields are loaded
+        self.assertEqual(result[0].get_deferred_fields() & {'name', 'marketplace_id'}, {'name'})
+        self.assertEqual(dict(Item.objects.values_list('marketplace_id', 'name')),
+                         {1: 'first', 2: 'changed', 3: 'new'})
+
+    def test_upsert_without_update_fields_keeps_rows(self):
+        existing = Item.objects.create(name='old', marketplace_id=1, marketplace_source=self.marketplace)
+        result = bulk_upsert(Item, [self._item(1, 'changed'), self._item(1, 'changed twice')],
+                             ['marketplace_source', 'marketplace_id'], [], ['id', 'name'])
+
+        self.assertEqual([(item.pk, item.name) for item in result], [(existing.pk, 'old')])
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_insert_and_update_values(self):
+        inserted = bulk_insert_values(Brand, ['name', 'marketplace_id', 'marketplace_source'],
+                                      [(f'brand {i}', i, self.marketplace.pk) for i in range(5)], batch_size=2)
+        self.assertEqual(inserted, 5)
+        self.assertFalse(Brand.objects.filter(created_at__isnull=True).exists())
+
+        rows = [(pk, f'renamed {marketplace_id}') for pk, marketplace_id in
+                Brand.objects.filter(marketplace_id__lt=2).values_list('pk', 'marketplace_id')]
+        self.assertEqual(bulk_update_values(Brand, ['name'], rows), 2)
+        self.assertEqual(sorted(Brand.objects.values_list('name', flat=True)),
+                         ['brand 2', 'brand 3', 'brand 4', 'renamed 0', 'renamed 1'])
+
+    def test_relations_buffer_skips_existing_pairs(self):
+        items = [Item.objects.create(name=f'item {i}', marketplace_id=i, marketplace_source=self.marketplace)
+                 for i in range(2)]
+        category = ItemCategory.objects.create(name='category', marketplace_source=self.marketplace)
+        buffer = RelationsBuffer()
+        for item in items:
+            buffer.add(Item.categories, item.pk, category.pk)
+            buffer.add(Item.categories, item.pk, category.pk)
+        buffer.flush()
+        buffer.add(Item.categories, items[0].pk, category.pk)
+        buffer.flush()
+        self.assertEqual(Item.categories.through.objects.count(), 2)
+
+
+class ClaimBatchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        marketplace = Marketplace.objects.create(name='Test')
+        start = now() - timedelta(hours=1)
+        Item.objects.bulk_create([Item(name=f'item {i}', marketplace_id=i, marketplace_source=marketplace,
+                                       next_parse_time=start + timedelta(minutes=i)) for i in range(5)])
+
+    def _claim(self, limit: int):
+        items = claim_batch(Item.objects.filter(next_parse_time__lte=now()), 'start_parse_time', ['next_parse_time'],
+                            limit, timedelta(minutes=30))
+        return sorted(item.marketplace_id for item in items)
+
+    def test_claims_in_order_without_repeats(self):
+        self.assertEqual(self._claim(2), [0, 1])
+        self.assertEqual(self._claim(2), [2, 3])
+        self.assertEqual(self._claim(2), [4])
+        self.assertEqual(self._claim(2), [])
+        self.assertFalse(Item.objects.filter(start_parse_time__isnull=True).exists())
+
+    def test_expired_lease_is_claimed_again(self):
+        self.assertEqual(self._claim(3), [0, 1, 2])
+        self.assertEqual(self._claim(1), [3])
+        with mock.patch('core.utils.work_queue.now', return_value=now() + timedelta(minutes=31)):
+            self.assertEqual(self._claim(3), [0, 1, 2])
+
+
+class RebuildMpttTreeTest(TestCase):
+    def test_same_fields_as_mptt_rebuild(self):
+        marketplace = Marketplace.objects.create(name='Test')
+        with ItemCategory.objects.disable_mptt_updates():
+            for root_name in ['b', 'a']:
+                root = ItemCategory.objects.create(name=root_name, marketplace_source=marketplace)
+                for child_name in ['y', 'x', 'z']:
+                    child = ItemCategory.objects.create(name=child_name, parent=root, marketplace_source=marketplace)
+                    ItemCategory.objects.create(name='leaf', parent=child, marketplace_source=marketplace)
+        fields = ['pk', 'lft', 'rght', 'tree_id', 'level']
+
+        self.assertEqual(rebuild_mptt_tree(ItemCategory), ItemCategory.objects.count())
+        rebuilt = list(ItemCategory.objects.order_by('pk').values_list(*fields))
+        ItemCategory.objects.rebuild()
+        self.assertEqual(rebuilt, list(ItemCategory.objects.order_by('pk').values_list(*fields)))
+        self.assertEqual(rebuild_mptt_tree(ItemCategory), 0)
+
+
+class TreeSnapshotTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'tree.jsonl')
+
+    def test_round_trip(self):
+        root = Node('Root', 'https://example.com/catalog/root?sort=1', items_number=10)
+        child = Node('Child', 'https://example.com/catalog/root/child', parent=root, items_number=5)
+        # Normalizing twice would strip the trailing space
+        child.name = 'child \n'
+        root.descendants.append(child)
+        child.descendants.append(Node('Leaf', 'https://example.com/catalog/root/child/leaf', parent=child))
+        other_root = Node('Other', 'https://example.com/catalog/other')
+
+        self.assertEqual(dump_tree([root, other_root], self.path), 4)
+        loaded = load_tree(self.path)
+
+        def describe(roots):
+            return [(node.name, node.marketplace_url, node.items_number,
+                     node.parent.marketplace_url if node.parent else None) for node in iter_nodes(roots)]
+        self.assertEqual(describe(loaded), describe([root, other_root]))
+
+    def test_wrong_snapshot_is_rejected(self):
+        dump_tree([Node('root', 'https://example.com/catalog/root')], self.path)
+        with open(self.path) as file:
+            lines = file.read().splitlines()
+
+        for broken in [[lines[0].replace('"version": 1', '"version": 2')] + lines[1:],
+                       [lines[0], '[0, 5, "root", "https://example.com/catalog/root", 0]'],
+                       [lines[0]]]:
+            with open(self.path, 'w') as file:
+                file.write('\n'.join(broken) + '\n')
+            with self.assertRaises(SalesUpdaterError):
+                load_tree(self.path)
+
+
+class ModelResolverTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.marketplace = Marketplace.objects.create(name='Test')
+
+    def test_missing_rows_are_created_once(self):
+        Brand.objects.create(name='existing', marketplace_id=1, marketplace_source=self.marketplace)
+        resolver = ModelResolver(Brand, 'marketplace_id')
+        params = [{'name': 'existing', 'marketplace_id': 1}, {'name': 'new', 'marketplace_id': 2},
+                  {'name': 'new', 'marketplace_id': 2}]
+
+        resolved = resolver.resolve(self.marketplace, params)
+        self.assertEqual({key: brand.name for key, brand in resolved.items()}, {1: 'existing', 2: 'new'})
+        self.assertEqual(Brand.objects.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve(self.marketplace, params), resolved)
+
+    def test_rows_without_key_are_resolved_by_name(self):
+        resolver = ModelResolver(Seller, 'marketplace_id')
+        to_fill = [{'seller': {'name': 'shop', 'marketplace_id': None}}]
+        resolver.fill(self.marketplace, to_fill, 'seller')
+        self.assertEqual(to_fill[0]['seller'], Seller.objects.get(name='shop', marketplace_id__isnull=True))
+
+    def test_deleted_row_is_invalidated(self):
+        resolver = ModelResolver(Brand, 'marketplace_id')
+        brand = resolver.resolve(self.marketplace, [{'name': 'brand', 'marketplace_id': 1}])[1]
+        brand.delete()
+        new_brand = resolver.resolve(self.marketplace, [{'name': 'brand', 'marketplace_id': 1}])[1]
+        self.assertNotEqual(new_brand.pk, brand.pk)
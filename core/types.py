@@ -1,6 +1,6 @@
 from datetime import timedelta
-from typing import Dict, Any
-from dataclasses import dataclass
+from typing import Dict, Any, List, Union, Tuple
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -19,6 +19,31 @@ class ScraperConfigs:
     categories_parse_frequency: timedelta
     images_parse_frequency: timedelta
     items_per_page: int
+    connections_limit: int
+    connections_limit_per_host: int
+    keepalive_timeout: float
+    dns_cache_ttl: int
+    item_pages_window: int
+    dimensions_cache_size: int
+    revisions_only_changed: bool
+    revision_chunk_size: int
+    revision_concurrency: int
+    revision_batches_in_flight: int
+    revisions_lease_timeout: timedelta
+    images_batch_size: int
+    images_concurrency: int
+    images_max_size: int
+    images_lease_timeout: timedelta
+    unused_files_grace_period: timedelta
+    make_thumbnails: bool
+    thumbnail_size: Tuple[int, int]
+    thumbnail_format: str
+    thumbnails_workers: int
+    categories_concurrency: int
+    categories_node_attempts: int
+    categories_checkpoint_step: int
+    categories_checkpoint_path: str
+    categories_snapshots_dir: str
 
 
 @dataclass
@@ -28,3 +53,35 @@ class RequestBody:
     parsing_type: str = 'bs'
     headers: Dict[str, Any] = None
     params: Dict[str, Any] = None
+    # Used by 'image' parsing type. Response body is streamed to a temporary file in download_dir
+    download_dir: str = None
+    max_size: int = None
+
+
+@dataclass
+class DownloadedFile:
+    path: str
+    content_hash: str
+    size: int
+
+
+@dataclass
+class CatalogPage:
+    number: int
+    is_last: bool = False
+    is_empty: bool = False
+    items_in_category: Union[int, None] = None
+    item_ids: List[int] = field(default_factory=list)
+    img_id_to_objs: Dict[int, Any] = field(default_factory=dict)
+    img_link_to_ids: Dict[str, int] = field(default_factory=dict)
+    items_info: List[Dict] = field(default_factory=list)
+
+
+@dataclass
+class CategoryTreeDiff:
+    """Urls of categories which are changed by the last crawl"""
+    added: List[str] = field(default_factory=list)
+    moved: List[str] = field(default_factory=list)
+    renamed: List[str] = field(default_factory=list)
+    restored: List[str] = field(default_factory=list)
+    vanished: List[str] = field(default_factory=list)
@@ -0,0 +1,217 @@
+from collections import defaultdict
+from typing import List, Any, Union, Tuple, Iterable
+
+from django.db import connections, router, transaction
+from django.db.models import Model
+from django.utils.timezone import now
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+
+
+def bulk_upsert(model: Union[Model, Any], objs: List[Model], unique_fields: List[str], update_fields: List[str],
+                returning: List[str], batch_size: int = 1000) -> List[Model]:
+    """
+    Inserts objs or updates update_fields of already existing rows matched by unique_fields.
+    There must be unique constraint on unique_fields. Objects with the same unique key are written once (last wins).
+
+    :return: model instances with only returning fields loaded, one per unique key, in the order of unique keys
+    """
+    if not objs:
+        return []
+
+    db = router.db_for_write(model)
+    unique_attnames = [model._meta.get_field(name).attname for name in unique_fields]
+    key_to_obj = {}
+    for obj in objs:
+        key_to_obj[tuple(getattr(obj, attname) for attname in unique_attnames)] = obj
+    # Sorted keys make concurrent upserts lock rows in the same order, so they can not deadlock
+    objs = [key_to_obj[key] for key in sorted(key_to_obj)]
+    # Unique fields are always loaded to match returned rows with objs. Model.from_db expects model fields order
+    returning = set(model._meta.get_field(name).attname for name in returning) | set(unique_attnames)
+    returning = [field.attname for field in model._meta.concrete_fields if field.attname in returning]
+
+    if connections[db].vendor == 'postgresql':
+        result = []
+        for i in range(0, len(objs), batch_size):
+            result.extend(_postgresql_upsert(model, objs[i:i + batch_size], db, unique_fields, update_fields,
+                                             returning))
+    else:
+        result = _fallback_upsert(model, objs, db, unique_attnames, update_fields, returning)
+
+    result.sort(key=lambda obj: tuple(getattr(obj, attname) for attname in unique_attnames))
+    return result
+
+
+def _postgresql_upsert(model: Union[Model, Any], objs: List[Model], db: str, unique_fields: List[str],
+                       update_fields: List[str], returning: List[str]) -> List[Model]:
+    connection = connections[db]
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+
+    rows, params = [], []
+    for obj in objs:
+        rows.append(f"({', '.join(['%s'] * len(fields))})")
+        for field in fields:
+            # pre_save fills auto_now and auto_now_add fields
+            params.append(field.get_db_prep_save(field.pre_save(obj, add=True), connection=connection))
+
+    conflict_columns = ', '.join(quote(model._meta.get_field(name).column) for name in unique_fields)
+    returning_columns = ', '.join(quote(model._meta.get_field(attname).column) for attname in returning)
+    sql = f"INSERT INTO {quote(model._meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) " \
+          f"VALUES {', '.join(rows)} ON CONFLICT ({conflict_columns}) "
+
+    update_columns = [model._meta.get_field(name).column for name in update_fields]
+    if update_columns:
+        update_columns += [field.column for field in fields if getattr(field, 'auto_now', False)]
+        sql += f"DO UPDATE SET {', '.join(f'{quote(column)} = EXCLUDED.{quote(column)}' for column in update_columns)}"
+        sql += f" RETURNING {returning_columns}"
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [model.from_db(db, returning, row) for row in cursor.fetchall()]
+
+    # Rows skipped by DO NOTHING are not returned, so existing ones are selected afterwards
+    sql += f"DO NOTHING RETURNING {returning_columns}"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        result = [model.from_db(db, returning, row) for row in cursor.fetchall()]
+    inserted_keys = {_get_key(model, obj, unique_fields) for obj in result}
+    existing_objs = [obj for obj in objs if _get_key(model, obj, unique_fields) not in inserted_keys]
+    result.extend(_select_by_keys(model, existing_objs, db, unique_fields, returning))
+    return result
+
+
+def _fallback_upsert(model: Union[Model, Any], objs: List[Model], db: str, unique_attnames: List[str],
+                     update_fields: List[str], returning: List[str]) -> List[Model]:
+    """Works for every backend, but needs several queries per batch. Used for SQLite"""
+    existing = {_get_key(model, obj, unique_attnames): obj
+                for obj in _select_by_keys(model, objs, db, unique_attnames, ['pk'] + update_fields)}
+    to_create, to_update = [], []
+    for obj in objs:
+        existing_obj = existing.get(_get_key(model, obj, unique_attnames))
+        if existing_obj is None:
+            to_create.append(obj)
+        elif update_fields:
+            for name in update_fields:
+                setattr(existing_obj, name, getattr(obj, name))
+            to_update.append(existing_obj)
+
+    model.objects.using(db).bulk_create(to_create)
+    if to_update:
+        model.objects.using(db).bulk_update(to_update, update_fields)
+    return _select_by_keys(model, objs, db, unique_attnames, returning)
+
+
+def _select_by_keys(model: Union[Model, Any], objs: List[Model], db: str, unique_attnames: List[str],
+                    fields: List[str]) -> List[Model]:
+    if not objs:
+        return []
+    keys = {_get_key(model, obj, unique_attnames) for obj in objs}
+    filters = {f'{attname}__in': {key[i] for key in keys} for i, attname in enumerate(unique_attnames)}
+    selected = model.objects.using(db).filter(**filters).only(*fields)
+    return [obj for obj in selected if _get_key(model, obj, unique_attnames) in keys]
+
+
+def _get_attnames(model: Union[Model, Any], names: List[str]) -> List[str]:
+    return [model._meta.get_field(name).attname for name in names]
+
+
+def _get_key(model: Union[Model, Any], obj: Model, names: List[str]) -> Tuple:
+    return tuple(getattr(obj, attname) for attname in _get_attnames(model, names))
+
+
+def bulk_insert_values(model: Union[Model, Any], fields: List[str], rows: Iterable[Tuple],
+                       batch_size: int = 1000) -> int:
+    """
+    Inserts plain tuples of values without creating model instances. Values must be ready for DB, for foreign keys
+    it is primary key of related row. auto_now and auto_now_add fields are filled with current time
+    """
+    db = router.db_for_write(model)
+    connection = connections[db]
+    quote = connection.ops.quote_name
+
+    columns = [model._meta.get_field(name).column for name in fields]
+    auto_fields = [field for field in model._meta.concrete_fields
+                   if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    auto_values = tuple(field.get_db_prep_save(now(), connection=connection) for field in auto_fields)
+    columns += [field.column for field in auto_fields]
+
+    # SQLite has a limit for number of query params
+    batch_size = min(batch_size, connection.ops.bulk_batch_size(columns, [None] * batch_size) or batch_size)
+    placeholder = f"({', '.join(['%s'] * len(columns))})"
+    sql = f"INSERT INTO {quote(model._meta.db_table)} ({', '.join(quote(column) for column in columns)}) VALUES "
+
+    inserted, batch = 0, []
+    with connection.cursor() as cursor:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                cursor.execute(sql + ', '.join([placeholder] * len(batch)),
+                               [value for batch_row in batch for value in batch_row + auto_values])
+                inserted, batch = inserted + len(batch), []
+        if batch:
+            cursor.execute(sql + ', '.join([placeholder] * len(batch)),
+                           [value for batch_row in batch for value in batch_row + auto_values])
+            inserted += len(batch)
+    return inserted
+
+
+def bulk_update_values(model: Union[Model, Any], fields: List[str], rows: Iterable[Tuple],
+                       batch_size: int = 1000) -> int:
+    """
+    Updates fields of rows matched by primary key, every row is (pk, *values). Values must be ready for DB.
+    Unlike QuerySet.bulk_update it does not build CASE expression for every value, which is slow for many rows
+    """
+    db = router.db_for_write(model)
+    connection = connections[db]
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    model_fields = [model._meta.pk] + [model._meta.get_field(name) for name in fields]
+    columns = [quote(field.column) for field in model_fields]
+
+    rows = list(rows)
+    with connection.cursor() as cursor:
+        if connection.vendor != 'postgresql':
+            cursor.executemany(f"UPDATE {table} SET {', '.join(f'{column} = %s' for column in columns[1:])} "
+                               f"WHERE {columns[0]} = %s", [row[1:] + row[:1] for row in rows])
+            return len(rows)
+
+        # Types of VALUES columns are not known to PostgreSQL without casts
+        placeholder = f"({', '.join(f'%s::{field.cast_db_type(connection)}' for field in model_fields)})"
+        assignments = ', '.join(f'{column} = new_values.{column}' for column in columns[1:])
+        values_columns = ', '.join(columns)
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            cursor.execute(f"UPDATE {table} SET {assignments} "
+                           f"FROM (VALUES {', '.join([placeholder] * len(batch))}) AS new_values ({values_columns}) "
+                           f"WHERE {table}.{columns[0]} = new_values.{columns[0]}",
+                           [value for row in batch for value in row])
+    return len(rows)
+
+
+def bulk_add_relations(relation: ManyToManyDescriptor, pairs: Iterable[Tuple[int, int]],
+                       batch_size: int = 1000) -> None:
+    """
+    Writes (source_id, target_id) pairs of many-to-many relation, like Item.categories, straight into through table.
+    Already existing pairs are skipped by the unique constraint of through table
+    """
+    through_meta = relation.through._meta
+    source_name = through_meta.get_field(relation.field.m2m_field_name()).attname
+    target_name = through_meta.get_field(relation.field.m2m_reverse_field_name()).attname
+    through_objs = [relation.through(**{source_name: source_id, target_name: target_id})
+                    for source_id, target_id in set(pairs)]
+    relation.through.objects.bulk_create(through_objs, batch_size=batch_size, ignore_conflicts=True)
+
+
+class RelationsBuffer:
+    """Collects pairs of many-to-many relations to write all of them in one transaction"""
+
+    def __init__(self):
+        self.relation_to_pairs = defaultdict(set)
+
+    def add(self, relation: ManyToManyDescriptor, source_id: int, target_id: int) -> None:
+        self.relation_to_pairs[relation].add((source_id, target_id))
+
+    def flush(self) -> None:
+        with transaction.atomic():
+            for relation, pairs in self.relation_to_pairs.items():
+                bulk_add_relations(relation, pairs)
+        self.relation_to_pairs.clear()
@@ -1,25 +1,61 @@
 import asyncio
+import hashlib
 import json
-from typing import Union, Dict, Tuple
+import os
+import tempfile
+from typing import Union, Dict, Tuple, Awaitable, Any
 
 import aiohttp
 from bs4 import BeautifulSoup
 
-from core.types import RequestBody
+from core.types import RequestBody, DownloadedFile
 from core.utils.proxy_manager import ProxyManager
 from core.utils.logging_helpers import get_logger
 
 logger = get_logger()
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class Connector:
-    """Here is we send all url requests"""
+    """Here is we send all url requests
+
+    Connector keeps one event loop and one pooled aiohttp session per process. They are created lazily on the first
+    request (or explicitly with open) and live until close is called. Loop and session inherited from the parent
+    process through fork are never reused, every worker process gets its own ones.
+    """
 
-    def __init__(self, use_proxy=True, try_count=10):
+    def __init__(self, use_proxy=True, try_count=10, limit=100, limit_per_host=0, keepalive_timeout=15.0,
+                 dns_cache_ttl=10):
         self.pm = ProxyManager()
         self.use_proxy = use_proxy
         self.try_count = try_count
 
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+
+        self._pid = None
+        self._loop = None
+        self._session = None
+
+    def open(self) -> None:
+        self.run(self._get_session())
+
+    def close(self) -> None:
+        """Must be called outside of running event loop"""
+        self._check_owner_process()
+        if self._session is not None and not self._session.closed:
+            self.run(self._session.close())
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.close()
+        self._loop, self._session = None, None
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Replacement for asyncio.run, which keeps event loop and connections alive between calls"""
+        return self._get_loop().run_until_complete(coroutine)
+
     @staticmethod
     def is_captcha_checker(bs: BeautifulSoup) -> bool:
         for frame in bs.findAll('iframe'):
@@ -33,17 +69,19 @@ class Connector:
 
     async def get_page(self, request_info: RequestBody) -> Union[Tuple[BeautifulSoup, bool, int],
                                                                  Tuple[Dict, bool, int],
-                                                                 Tuple[None, None, None], Tuple[bytes, None, int]]:
-        async with aiohttp.ClientSession() as session:
-            while True:
-                for i in range(self.try_count):
+                                                                 Tuple[None, None, None],
+                                                                 Tuple[Union[DownloadedFile, None], Dict, int]]:
+        session = await self._get_session()
+        while True:
+            for i in range(self.try_count):
+                try:
                     try:
-                        try:
-                            response = await self._send_request(request_info, session)
-                        except aiohttp.ClientError as e:
-                            logger.warning(f'aiohttp error: {e}')
-                            continue
+                        response = await self._send_request(request_info, session)
+                    except aiohttp.ClientError as e:
+                        logger.warning(f'aiohttp error: {e}')
+                        continue
 
+                    try:
                         is_captcha = False
                         if request_info.parsing_type == 'bs':
                             try:
@@ -61,14 +99,69 @@ class Connector:
                                 logger.warning(
                                     f'JSONDecoderError: {e.msg}')
                         elif request_info.parsing_type == 'image':
-                            content = await response.content.read()
-                            return content, None, response.status
+                            validators = self._get_validators(response)
+                            if response.status != 200:
+                                # 304 is for conditional request if image is not modified, there is no body
+                                return None, validators, response.status
+                            try:
+                                downloaded = await self._download_to_file(response, request_info)
+                            except aiohttp.ClientPayloadError as e:
+                                logger.warning(f'ClientPayloadError: {e} for image. Try another attempt')
+                                continue
+                            return downloaded, validators, response.status
                         else:
                             logger.warning('Unrecognized type of parsing')
-                    except asyncio.TimeoutError as e:
-                        logger.warning(f'Asyncio timeout error occurred {e}. Try another attempt')
-                logger.error(f"All attempts to connect for {request_info.url[:120]} and {request_info.url[-10:]} "
-                             f"have been used. Trying another {self.try_count} attempts")
+                    finally:
+                        # Connection goes back to the pool only after release
+                        response.release()
+                except asyncio.TimeoutError as e:
+                    logger.warning(f'Asyncio timeout error occurred {e}. Try another attempt')
+            logger.error(f"All attempts to connect for {request_info.url[:120]} and {request_info.url[-10:]} "
+                         f"have been used. Trying another {self.try_count} attempts")
+
+    @staticmethod
+    def get_conditional_headers(etag: str = '', last_modified: str = '') -> Dict[str, str]:
+        """Headers for revalidation of a resource by validators returned with its previous response"""
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    @staticmethod
+    async def _download_to_file(response: aiohttp.ClientResponse,
+                                request_info: RequestBody) -> Union[DownloadedFile, None]:
+        """
+        Body is written by chunks and hashed on the way, so it is never kept in memory as a whole.
+        :return: None if body is bigger than request_info.max_size
+        """
+        max_size = request_info.max_size
+        if max_size is not None and (response.content_length or 0) > max_size:
+            logger.error(f'{request_info.url} is too large: {response.content_length} bytes')
+            return None
+
+        os.makedirs(request_info.download_dir, exist_ok=True)
+        file_descriptor, path = tempfile.mkstemp(dir=request_info.download_dir, suffix='.part')
+        content_hash, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        logger.error(f'{request_info.url} is too large: more than {max_size} bytes')
+                        os.remove(path)
+                        return None
+                    content_hash.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return DownloadedFile(path, content_hash.hexdigest(), size)
+
+    @staticmethod
+    def _get_validators(response: aiohttp.ClientResponse) -> Dict[str, str]:
+        return {name: response.headers[name] for name in ['ETag', 'Last-Modified'] if name in response.headers}
 
     def _parse_to_bs(self, content: bytes, request_info: RequestBody) -> (BeautifulSoup, bool):
         bs = BeautifulSoup(content, 'lxml')
@@ -90,7 +183,29 @@ class Connector:
                 raise e
 
     async def _send_request(self, request_info: RequestBody, session: aiohttp.ClientSession) -> aiohttp.ClientResponse:
-        proxies = self.pm.get_proxy() if self.use_proxy else None
+        proxies = self.pm.get_proxy() if self.use_proxy else {'http': None}
         response = await session.request(method=request_info.method, url=request_info.url, headers=request_info.headers,
                                          proxy=proxies['http'], params=request_info.params)
         return response
+
+    def _check_owner_process(self) -> None:
+        if self._pid != os.getpid():
+            # Loop and session are copied from the parent process. Closing them here would break the parent
+            self._pid = os.getpid()
+            self._loop, self._session = None, None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        self._check_owner_process()
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        self._check_owner_process()
+        if self._session is None or self._session.closed:
+            tcp_connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                                 keepalive_timeout=self.keepalive_timeout,
+                                                 ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=tcp_connector)
+        return self._session
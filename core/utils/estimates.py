@@ -0,0 +1,34 @@
+import json
+import time
+
+from django.db import connections
+from django.db.models import QuerySet
+
+from core.utils.cache import LRUCache
+
+estimates_cache = LRUCache(maxsize=64)
+
+
+def estimate_count(key: str, queryset: QuerySet, ttl: float = 60.0) -> int:
+    """
+    Number of rows in queryset without counting them. PostgreSQL planner estimate is used, other backends
+    run COUNT. Result is cached by key for ttl seconds in the current process
+    """
+    cached = estimates_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        count = int(plan[0]['Plan']['Plan Rows'])
+    else:
+        count = queryset.count()
+
+    estimates_cache.put(key, (time.monotonic() + ttl, count))
+    return count
@@ -0,0 +1,127 @@
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple, Union, Any
+
+from django.db import connection, connections
+from django.db.models import Model
+from django.utils.timezone import now
+
+from core.utils.logging_helpers import get_logger
+
+logger = get_logger()
+
+INTERVALS = {'day': timedelta(days=1), 'week': timedelta(days=7)}
+# Bound of a partition can be MINVALUE/MAXVALUE for the legacy table attached during migration
+BOUND_PATTERN = re.compile(r"FROM \((?:'([^']+)'|MINVALUE)\) TO \((?:'([^']+)'|MAXVALUE)\)")
+PARTITIONS_CHECK_INTERVAL = 60 * 60
+
+last_partitions_check = None
+
+
+def is_partitioning_supported() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def get_period_start(moment: datetime, interval: str) -> datetime:
+    """Days start at midnight UTC, weeks start on Monday"""
+    moment = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        moment -= timedelta(days=moment.weekday())
+    return moment
+
+
+def get_partition_name(model: Union[Model, Any], start: datetime) -> str:
+    return f'{model._meta.db_table}_p{start:%Y%m%d}'
+
+
+def get_partitions(model: Union[Model, Any]) -> List[Tuple[str, Union[datetime, None], Union[datetime, None]]]:
+    """:return: (name, lower bound, upper bound) of every attached partition. None means unbounded"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+                       "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                       "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                       "WHERE parent.relname = %s", [model._meta.db_table])
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_PATTERN.search(bound)
+        if match is None:
+            # DEFAULT partition has no bounds
+            partitions.append((name, None, None))
+            continue
+        lower, upper = [_parse_bound(value) if value else None for value in match.groups()]
+        partitions.append((name, lower, upper))
+    partitions.sort(key=lambda partition: partition[1] or datetime.min.replace(tzinfo=timezone.utc))
+    return partitions
+
+
+def create_partitions(model: Union[Model, Any], start: datetime, end: datetime, interval: str = 'week') -> List[str]:
+    """Creates partitions covering [start, end). Ranges which are already covered by any partition are skipped"""
+    existing = [(lower, upper) for _, lower, upper in get_partitions(model)]
+    created = []
+    period_start = get_period_start(start, interval)
+    while period_start < end:
+        period_end = period_start + INTERVALS[interval]
+        is_overlapped = any((lower is None or lower < period_end) and (upper is None or period_start < upper)
+                            for lower, upper in existing if (lower, upper) != (None, None))
+        if not is_overlapped:
+            name = get_partition_name(model, period_start)
+            with connection.cursor() as cursor:
+                cursor.execute(f'CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(name)} '
+                               f'PARTITION OF {connection.ops.quote_name(model._meta.db_table)} '
+                               f'FOR VALUES FROM (%s) TO (%s)', [period_start, period_end])
+            existing.append((period_start, period_end))
+            created.append(name)
+        period_start = period_end
+    return created
+
+
+def ensure_partitions(models: List[Union[Model, Any]], periods: int = 2, interval: str = 'week') -> None:
+    """Cheap check that rows created in the nearest periods have partitions to go to"""
+    if not is_partitioning_supported():
+        return
+    start = now()
+    for model in models:
+        create_partitions(model, start, start + INTERVALS[interval] * periods, interval=interval)
+
+
+def ensure_partitions_periodically(models: List[Union[Model, Any]],
+                                   check_interval: float = PARTITIONS_CHECK_INTERVAL) -> None:
+    """
+    For loops of long running workers, which would outlive premade partitions otherwise. Partitions are checked once
+    per check_interval seconds. DB connections are closed afterwards, so pool processes forked later do not share them
+    """
+    global last_partitions_check
+    if last_partitions_check is not None and time.monotonic() - last_partitions_check < check_interval:
+        return
+    last_partitions_check = time.monotonic()
+    ensure_partitions(models)
+    connections.close_all()
+
+
+def remove_partitions(model: Union[Model, Any], older_than: datetime, mode: str = 'detach') -> List[str]:
+    """
+    Removes partitions which contain only rows created before older_than.
+    'detach' keeps removed partitions as standalone tables for archiving, 'drop' deletes them with all rows
+    """
+    removed = []
+    for name, _, upper in get_partitions(model):
+        if upper is None or upper > older_than:
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {connection.ops.quote_name(model._meta.db_table)} '
+                           f'DETACH PARTITION {connection.ops.quote_name(name)}')
+            if mode == 'drop':
+                cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
+        logger.info(f'Partition {name} of {model._meta.db_table} has been removed with mode {mode}')
+        removed.append(name)
+    return removed
+
+
+def _parse_bound(value: str) -> datetime:
+    # Postgres prints UTC offset without minutes, which python 3.8 can not parse
+    if re.search(r'[+-]\d\d$', value):
+        value += ':00'
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
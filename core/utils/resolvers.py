@@ -0,0 +1,93 @@
+from typing import Dict, Hashable, Iterable, List, Union, Any
+
+from django.db.models import Model, Q
+from django.db.models.signals import post_delete, post_save
+
+from core.models import Marketplace
+from core.utils.cache import LRUCache
+
+
+class ModelResolver:
+    """
+    Resolves rows of small dimension models (Brand, Colour, Seller) for a batch of items at once.
+    All requested rows are selected with one IN query, missing ones are created with one bulk insert.
+
+    Rows are identified by key_field inside marketplace source. Rows with empty key_field are identified by name.
+    Resolved rows are kept in process-local LRU cache with (marketplace_source_id, key) keys. Cache entries are
+    invalidated by model signals, so bulk deletes have to call cache.clear explicitly
+    """
+
+    def __init__(self, model: Union[Model, Any], key_field: str, cache_size: int = 10000):
+        self.model = model
+        self.key_field = key_field
+        self.cache = LRUCache(maxsize=cache_size)
+
+        post_save.connect(self._invalidate, sender=model, weak=False)
+        post_delete.connect(self._invalidate, sender=model, weak=False)
+
+    def get_key(self, obj: Union[Dict[str, Any], Model]) -> Hashable:
+        if isinstance(obj, dict):
+            value, name = obj.get(self.key_field), obj.get('name')
+        else:
+            value, name = getattr(obj, self.key_field), obj.name
+        return value if value is not None else (None, name)
+
+    def resolve(self, marketplace_source: Marketplace, params_list: Iterable[Dict[str, Any]]) -> Dict[Hashable, Model]:
+        key_to_params = {}
+        for params in params_list:
+            key_to_params.setdefault(self.get_key(params), params)
+        if not key_to_params:
+            return {}
+
+        key_to_obj, not_cached = {}, []
+        for key in key_to_params:
+            obj = self.cache.get((marketplace_source.id, key))
+            if obj is not None:
+                key_to_obj[key] = obj
+            else:
+                not_cached.append(key)
+
+        if not_cached:
+            selected = self._select(marketplace_source, not_cached)
+            missing = [key for key in not_cached if key not in selected]
+            if missing:
+                new_objs = [self.model(marketplace_source=marketplace_source, **key_to_params[key])
+                            for key in missing]
+                # Models have no unique constraint, so concurrent resolvers would create duplicates. Callers must
+                # hold a lock around resolve and saving, like add_items_to_db does
+                self.model.objects.bulk_create(new_objs)
+                selected.update(self._select(marketplace_source, missing))
+
+            for key, obj in selected.items():
+                self.cache.put((marketplace_source.id, key), obj)
+            key_to_obj.update(selected)
+        return key_to_obj
+
+    def fill(self, marketplace_source: Marketplace, to_fill: List[Dict], field_name: str) -> None:
+        """Replaces params in field_name of every dict in to_fill with resolved model instance"""
+        key_to_obj = self.resolve(marketplace_source, [info[field_name] for info in to_fill])
+        for info in to_fill:
+            info[field_name] = key_to_obj[self.get_key(info[field_name])]
+
+    def _select(self, marketplace_source: Marketplace, keys: Iterable[Hashable]) -> Dict[Hashable, Model]:
+        values, names = [], []
+        for key in keys:
+            if isinstance(key, tuple):
+                names.append(key[1])
+            else:
+                values.append(key)
+
+        condition = Q()
+        if values:
+            condition |= Q(**{f'{self.key_field}__in': values})
+        if names:
+            condition |= Q(**{f'{self.key_field}__isnull': True, 'name__in': names})
+
+        key_to_obj = {}
+        # Duplicates could exist from old versions. The earliest one is used everywhere
+        for obj in self.model.objects.filter(condition, marketplace_source=marketplace_source).order_by('pk'):
+            key_to_obj.setdefault(self.get_key(obj), obj)
+        return key_to_obj
+
+    def _invalidate(self, sender: Any, instance: Model, **kwargs) -> None:
+        self.cache.invalidate((instance.marketplace_source_id, self.get_key(instance)))
@@ -0,0 +1,42 @@
+import os
+import tempfile
+from typing import Tuple, Union
+
+from PIL import Image as PILImage
+
+from core.utils.logging_helpers import get_logger
+
+logger = get_logger()
+
+THUMBNAIL_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def make_thumbnail(source_path: str, target_path: str, size: Tuple[int, int], image_format: str = 'JPEG',
+                   file_mode: Union[int, None] = None) -> bool:
+    """
+    Usually runs in another process, so it gets only paths. Thumbnail fits into size and keeps aspect ratio.
+    It is written to a temporary file first, so target_path never has a partly written file
+    """
+    try:
+        with PILImage.open(source_path) as image:
+            # JPEG is decoded at reduced scale, which is much faster for big images
+            image.draft('RGB', size)
+            thumbnail = image.convert('RGB')
+        thumbnail.thumbnail(size, PILImage.LANCZOS)
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                thumbnail.save(file, format=image_format, quality=85)
+            if file_mode is not None:
+                os.chmod(temp_path, file_mode)
+            os.replace(temp_path, target_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except (OSError, ValueError) as e:
+        # Pillow raises OSError for broken and unknown images, ValueError for unsupported formats
+        logger.error(f'Can not make thumbnail for {source_path}: {e}')
+        return False
+    return True
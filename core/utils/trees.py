@@ -1,4 +1,21 @@
+import json
+import os
+from collections import defaultdict, deque
+from typing import Union, Any, List, Iterator
+
+from django.db.models import Model
+
+from core.exceptions import SalesUpdaterError
+from core.utils.bulk_operations import bulk_update_values
+
+TREE_SNAPSHOT_FORMAT = 'mp_category_tree'
+TREE_SNAPSHOT_VERSION = 1
+
+
 class Node:
+    # Trees have tens of thousands of nodes, slots make every node several times smaller
+    __slots__ = ('name', 'marketplace_url', 'descendants', 'db_id', 'parent', 'items_number')
+
     def __init__(self, name, marketplace_url=None, parent=None, db_id=None, items_number=0):
         self.name = name.lower().strip(' ').strip('\n')
 
@@ -18,3 +35,138 @@ class Node:
 
     def __repr__(self):
         return self.name
+
+
+def iter_levels(roots: List[Node]) -> Iterator[List[Node]]:
+    """Level order traversal without recursion. Every level is built only when the previous one is processed"""
+    level = list(roots)
+    while level:
+        yield level
+        level = [descendant for node in level for descendant in node.descendants]
+
+
+def iter_nodes(roots: List[Node]) -> Iterator[Node]:
+    for level in iter_levels(roots):
+        yield from level
+
+
+def find_node(roots: List[Node], marketplace_url: str) -> Union[Node, None]:
+    """:return: the first node with url in level order, its subtree is node.descendants"""
+    for node in iter_nodes(roots):
+        if node.marketplace_url == marketplace_url:
+            return node
+    return None
+
+
+def dump_tree(roots: List[Node], path: str) -> int:
+    """
+    Snapshot is JSON lines. The first line is a header with format, version and number of nodes, then one line per
+    node: [id, parent_idx, name, url, items_number]. Nodes are in level order, so parent goes before its descendants
+
+    :return: number of written nodes
+    """
+    rows_num = 0
+    with open(f'{path}.part', 'w', encoding='utf-8') as file:
+        file.write(json.dumps({'format': TREE_SNAPSHOT_FORMAT, 'version': TREE_SNAPSHOT_VERSION,
+                               'nodes': count_nodes(roots)}) + '\n')
+        queue = deque((root, None) for root in roots)
+        while queue:
+            node, parent_index = queue.popleft()
+            file.write(json.dumps([rows_num, parent_index, node.name, node.marketplace_url, node.items_number],
+                                  ensure_ascii=False) + '\n')
+            queue.extend((descendant, rows_num) for descendant in node.descendants)
+            rows_num += 1
+    os.replace(f'{path}.part', path)
+    return rows_num
+
+
+def load_tree(path: str) -> List[Node]:
+    """
+    Reads snapshot written by dump_tree line by line. SalesUpdaterError is raised if it does not match the schema
+
+    :return: root nodes
+    """
+    nodes = []
+    with open(path, encoding='utf-8') as file:
+        try:
+            header = _parse_snapshot_line(file.readline(), 1)
+        except UnicodeDecodeError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != TREE_SNAPSHOT_FORMAT:
+            raise SalesUpdaterError(f'{path} is not a category tree snapshot')
+        if header.get('version') != TREE_SNAPSHOT_VERSION:
+            raise SalesUpdaterError(f'Unsupported version {header.get("version")} of category tree snapshot {path}')
+
+        for line_number, line in enumerate(file, start=2):
+            row = _parse_snapshot_line(line, line_number)
+            if not _is_valid_snapshot_row(row, len(nodes)):
+                raise SalesUpdaterError(f'Wrong row on line {line_number} of category tree snapshot {path}')
+            _, parent_index, name, url, items_number = row
+            parent = nodes[parent_index] if parent_index is not None else None
+            node = Node(name, url, parent=parent, items_number=items_number)
+            # Name is already normalized, normalizing it twice can change it
+            node.name = name
+            if parent is not None:
+                parent.descendants.append(node)
+            nodes.append(node)
+
+    if len(nodes) != header.get('nodes'):
+        raise SalesUpdaterError(f'Category tree snapshot {path} has {len(nodes)} nodes, '
+                                f'but {header.get("nodes")} are expected')
+    return [node for node in nodes if node.parent is None]
+
+
+def count_nodes(roots: List[Node]) -> int:
+    return sum(len(level) for level in iter_levels(roots))
+
+
+def _parse_snapshot_line(line: str, line_number: int) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise SalesUpdaterError(f'Line {line_number} of category tree snapshot is not JSON')
+
+
+def _is_valid_snapshot_row(row: Any, index: int) -> bool:
+    if not isinstance(row, list) or len(row) != 5:
+        return False
+    row_id, parent_index, name, url, items_number = row
+    # Parent must be already loaded
+    return row_id == index and (parent_index is None or isinstance(parent_index, int) and 0 <= parent_index < index) \
+        and isinstance(name, str) and isinstance(url, str) and isinstance(items_number, int)
+
+
+def rebuild_mptt_tree(model: Union[Model, Any]) -> int:
+    """
+    The same result as TreeManager.rebuild, which does two queries per node. Here the whole table is loaded with one
+    query, MPTT fields are computed in memory and only changed rows are written. Must be called in a transaction
+
+    :return: number of updated rows
+    """
+    opts = model._mptt_meta
+    fields = [opts.left_attr, opts.right_attr, opts.tree_id_attr, opts.level_attr]
+    parent_attname = model._meta.get_field(opts.parent_attr).attname
+
+    # Siblings are ordered by DB, so the order is the same as after TreeManager.rebuild
+    children, current_values = defaultdict(list), {}
+    for pk, parent_id, *values in model._tree_manager.order_by(*opts.order_insertion_by, 'pk').values_list(
+            'pk', parent_attname, *fields):
+        children[parent_id].append(pk)
+        current_values[pk] = tuple(values)
+
+    new_values = {}
+    for tree_id, root_pk in enumerate(children[None], 1):
+        counter, lefts = 1, {}
+        stack = [(root_pk, 0, True)]
+        while stack:
+            pk, level, is_entered = stack.pop()
+            if is_entered:
+                lefts[pk] = counter
+                stack.append((pk, level, False))
+                stack.extend((child_pk, level + 1, True) for child_pk in reversed(children[pk]))
+            else:
+                new_values[pk] = (lefts[pk], counter, tree_id, level)
+            counter += 1
+
+    changed = [(pk, *values) for pk, values in new_values.items() if values != current_values[pk]]
+    return bulk_update_values(model, fields, changed)
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+from typing import List, Union
+
+from django.db import connections, router, transaction
+from django.db.models import Model, Q, QuerySet
+from django.utils.timezone import now
+
+
+def claim_batch(queryset: QuerySet, lease_field: str, order_by: List[str], limit: int,
+                lease_timeout: Union[timedelta, None]) -> List[Model]:
+    """
+    Takes up to limit rows of queryset in order_by order by setting lease_field to current time.
+    Rows with lease older than lease_timeout are considered abandoned by crashed worker and are taken again.
+    If lease_timeout is None, queryset itself must exclude taken rows.
+    On PostgreSQL it is one UPDATE ... RETURNING query, rows locked by concurrent claims are skipped.
+
+    :return: claimed model instances with all concrete fields loaded
+    """
+    model = queryset.model
+    db = router.db_for_write(model)
+    connection = connections[db]
+    quote = connection.ops.quote_name
+    claim_time = now()
+
+    candidates = get_claim_candidates(queryset.using(db), lease_field, order_by, limit, lease_timeout, claim_time)
+    lease_column = model._meta.get_field(lease_field).column
+    pk_column = model._meta.pk.column
+
+    with transaction.atomic(using=db):
+        if connection.vendor == 'postgresql':
+            candidates = candidates.select_for_update(skip_locked=True)
+        candidates_sql, candidates_params = candidates.query.get_compiler(using=db).as_sql()
+        sql = f'UPDATE {quote(model._meta.db_table)} SET {quote(lease_column)} = %s ' \
+              f'WHERE {quote(pk_column)} IN ({candidates_sql})'
+        params = [model._meta.get_field(lease_field).get_db_prep_save(claim_time, connection=connection)]
+        params.extend(candidates_params)
+
+        if connection.vendor == 'postgresql':
+            attnames = [field.attname for field in model._meta.concrete_fields]
+            returning = ', '.join(quote(field.column) for field in model._meta.concrete_fields)
+            with connection.cursor() as cursor:
+                cursor.execute(f'{sql} RETURNING {returning}', params)
+                return [model.from_db(db, attnames, row) for row in cursor.fetchall()]
+
+        # Other backends lock the whole table for writing until commit, so no one else can take the same lease time
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return list(model.objects.using(db).filter(**{lease_field: claim_time}))
+
+
+def get_claim_candidates(queryset: QuerySet, lease_field: str, order_by: List[str], limit: int,
+                         lease_timeout: Union[timedelta, None], claim_time: datetime = None) -> QuerySet:
+    """Primary keys of rows which claim_batch takes, without taking them"""
+    if lease_timeout is not None:
+        claim_time = now() if claim_time is None else claim_time
+        queryset = queryset.filter(Q(**{f'{lease_field}__isnull': True}) |
+                                   Q(**{f'{lease_field}__lt': claim_time - lease_timeout}))
+    return queryset.order_by(*order_by).values('pk')[:limit]